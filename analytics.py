@@ -0,0 +1,162 @@
+from typing import *
+import sys
+import csv
+import argparse
+import datetime
+
+import numpy as np
+
+import columnar
+from columnar import PaymentColumns, INT_NULL
+
+# ============================
+# reports over the columnar export (see columnar.py)
+# all of them are vectorized. no python loop per payment
+# ============================
+
+def _amount(values:np.ndarray):
+    "INT_NULL -> 0"
+    return np.where(values == INT_NULL, 0, values)
+
+def select(cols:PaymentColumns, since:Optional[datetime.datetime]=None, until:Optional[datetime.datetime]=None, with_error:bool=True):
+    """
+    the payments in the period. until: inclusive, same as becky.py
+    the payments without datetime are dropped.
+    """
+    mask = cols.datetime != INT_NULL
+    if since is not None:
+        mask &= cols.datetime >= columnar._epoch(since)
+    if until is not None:
+        mask &= cols.datetime < columnar._epoch(until + datetime.timedelta(days=1))
+    if not with_error:
+        mask &= ~cols.has_error
+    if mask.all():
+        return cols
+    # store_names is the dictionary. kept as it is
+    return cols._replace(**{ name: getattr(cols, name)[mask] for name in cols._fields if name != 'store_names' })
+
+def _sums(keys:np.ndarray, size:int, cols:PaymentColumns):
+    "(count, total, use_point, use_cash) grouped by keys (0 <= key < size)"
+    def sum_of(values:np.ndarray):
+        # bincount sums in float64. exact while the sum is below 2**53 yen
+        return np.rint(np.bincount(keys, weights=_amount(values), minlength=size)).astype(np.int64)
+    return np.bincount(keys, minlength=size), sum_of(cols.total), sum_of(cols.use_point), sum_of(cols.use_cash)
+
+class MonthlyTotals(NamedTuple):
+    month:     np.ndarray   # datetime64[M]
+    count:     np.ndarray
+    total:     np.ndarray
+    use_point: np.ndarray
+    use_cash:  np.ndarray
+
+    @property
+    def charged(self):
+        "paid by other than point/cash (credit card etc.)"
+        return self.total - self.use_point - self.use_cash
+
+def monthly_totals(cols:PaymentColumns, skip_empty:bool=True):
+    "totals per calendar month. the months without payments are dropped when skip_empty"
+    cols = select(cols)
+    if not cols.rows:
+        empty = np.zeros(0, dtype=np.int64)
+        return MonthlyTotals(np.zeros(0, dtype='datetime64[M]'), empty, empty, empty, empty)
+    # datetime64[s] -> [M] per payment is slow. map the days through a table of the span instead
+    days   = cols.datetime // 86400
+    first_day = days.min()
+    day_months = np.arange(first_day, days.max() + 1).astype('datetime64[D]').astype('datetime64[M]').astype(np.int64)
+    first  = day_months[0]
+    keys   = (day_months - first)[days - first_day]
+    size   = int(day_months[-1] - first) + 1
+    count, total, point, cash = _sums(keys, size, cols)
+    month = (np.arange(size) + first).astype('datetime64[M]')
+    ret = MonthlyTotals(month, count, total, point, cash)
+    if skip_empty:
+        ret = MonthlyTotals(*(v[count > 0] for v in ret))
+    return ret
+
+class PointCashSplit(NamedTuple):
+    count:     int
+    total:     int
+    use_point: int
+    use_cash:  int
+
+    @property
+    def charged(self):
+        return self.total - self.use_point - self.use_cash
+
+def point_cash_split(cols:PaymentColumns):
+    "how the total of the period was paid"
+    cols = select(cols)
+    return PointCashSplit(cols.rows, int(_amount(cols.total).sum()), int(_amount(cols.use_point).sum()), int(_amount(cols.use_cash).sum()))
+
+class StoreRanking(NamedTuple):
+    store:     np.ndarray   # str
+    count:     np.ndarray
+    total:     np.ndarray
+    use_point: np.ndarray
+    use_cash:  np.ndarray
+
+RANKING_KEYS = ('total', 'count')
+
+def store_ranking(cols:PaymentColumns, top:Optional[int]=None, by:str='total'):
+    "stores in descending order of by ('total' or 'count'). the payments without store are ranked as ''"
+    cols  = select(cols)
+    size  = len(cols.store_names) + 1
+    # -1 (None) -> the last slot
+    keys  = np.where(cols.store_code < 0, size - 1, cols.store_code)
+    count, total, point, cash = _sums(keys, size, cols)
+    store = np.append(cols.store_names, '')
+    ranking = StoreRanking(store, count, total, point, cash)
+
+    used  = np.flatnonzero(count > 0)
+    # stable: the ties keep the order of the dictionary (first seen)
+    order = used[np.argsort(-getattr(ranking, by)[used], kind='stable')]
+    if top is not None:
+        order = order[:top]
+    return StoreRanking(*(v[order] for v in ranking))
+
+# === main ===
+def get_cli_option():
+    p = argparse.ArgumentParser()
+    p.add_argument('path', help='.npz/.parquet/.arrow written by becky.py --columnar, or the csv written by becky.py', type=str)
+    p.add_argument('-s', '--since', help='ex) 2025-01-01', type=str)
+    p.add_argument('-u', '--until', help='ex) 2025-01-01', type=str)
+    p.add_argument('--no-error', help='skip the payments parsed with errors', action='store_true')
+    p.add_argument('--convert', help='write the loaded columns to this file (.npz/.parquet/.arrow) too', type=str)
+    sub = p.add_subparsers(dest='command', required=True)
+
+    sub.add_parser('monthly', help='totals per month')
+    sub.add_parser('split', help='point/cash split of the total')
+    s = sub.add_parser('stores', help='store ranking')
+    s.add_argument('--top', help='number of stores', type=int, default=20)
+    s.add_argument('--by', help='ranking key', choices=RANKING_KEYS, default='total')
+    return p.parse_args()
+
+def _parse_date(d:Optional[str]):
+    if d is None:
+        return None
+    return datetime.datetime.strptime(d, "%Y-%m-%d")
+
+def main():
+    opt  = get_cli_option()
+    cols = columnar.load(opt.path)
+    if opt.convert:
+        columnar.save(opt.convert, cols)
+    cols = select(cols, _parse_date(opt.since), _parse_date(opt.until), not opt.no_error)
+
+    writer = csv.writer(sys.stdout, lineterminator='\n')
+    if opt.command == 'monthly':
+        m = monthly_totals(cols)
+        writer.writerow(['Month', 'Count', 'Total', 'UsePoint', 'UseCash', 'Charged'])
+        writer.writerows(zip(m.month.astype(str), m.count, m.total, m.use_point, m.use_cash, m.charged))
+    elif opt.command == 'split':
+        s = point_cash_split(cols)
+        writer.writerow(['Count', 'Total', 'UsePoint', 'UseCash', 'Charged'])
+        writer.writerow([s.count, s.total, s.use_point, s.use_cash, s.charged])
+    elif opt.command == 'stores':
+        r = store_ranking(cols, opt.top, opt.by)
+        writer.writerow(['Store', 'Count', 'Total', 'UsePoint', 'UseCash'])
+        writer.writerows(zip(r.store, r.count, r.total, r.use_point, r.use_cash))
+
+if __name__ == '__main__':
+    main()
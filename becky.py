@@ -3,45 +3,65 @@ import sys
 import io
 import csv
 import datetime
-import traceback
 import os.path
 import glob
+import json
+import heapq
 import argparse
 import contextlib
-import pdb
+import concurrent.futures
+import mmap
+import queue
+import threading
+import time
+import array
+import struct
+import hashlib
+import itertools
+import functools
 import email
 import email.message
 
 join_path = os.path.join
 
 import rakuten_pay_mail_parser as r_pay
+import parse_cache
+import extsort
+import stats
+import columnar
+import summary
+import mailsource
+import dedupe
+import quarantine
 
 class CLIParameter(NamedTuple):
     mailbox_path: str
     since: Optional[datetime.datetime]
     until: Optional[datetime.datetime]
+    full_scan: bool = False
+    workers: int = 1
+    cache_path: Optional[str] = None
+    idx_cache_dir: Optional[str] = None
+    prefetch_depth: int = 0
+    "number of batches read ahead by a background thread. 0: no read-ahead"
+    prefetch_bytes: int = 4 * 1024 * 1024
+    mail_format: str = mailsource.BECKY
+    "becky, mbox, maildir or eml. see mailsource.py"
+    dedupe_level: str = dedupe.MSGID
+    "off, msgid or receipt. see dedupe.py"
+    failure_samples: int = 3
+    "failed mails stored per signature. see quarantine.py"
 argv = None
-
-def _dump_mail(mail:email.message.Message, msg:str, filename:str):
-    # dump a raw mail stream
-    with open(f"{filename}.mail.txt", "wb") as h:
-        h.write(bytes(mail))
-
-    with open(f"{filename}.info.txt", "w", encoding='utf-8') as h:
-        print(msg, file=h, end='')
-
-def _dump_exception(ex:r_pay.UnexcpectedRakutenPayMailException):
-    stack_list = (ex.stack_trace_list or []) + [traceback.format_exc()]
-    rec = [
-        f"from: {ex.from_}",
-        f"subject: {ex.subject}",
-        f"msgid: {ex.msgid}",
-        "",
-        f"{ex.mail_body}",
-        "--------",
-        '--------'.join(stack_list),
-    ]
-    return '\n'.join(rec)
+cache: Optional[parse_cache.ParseCache] = None
+watermarks: Optional[Dict[str, 'FolderWatermark']] = None
+"loaded by --state. None: not an incremental run"
+new_watermarks: Dict[str, 'FolderWatermark'] = {}
+watermark_candidates: Dict[str, Tuple[str, List['FolderIdxEntity']]] = {}
+"mark key -> (folder, candidate entities). the failed ones are retried in the next run"
+failures: Optional[quarantine.FailureSink] = None
+"--failures. None: the failed mails are not stored"
+MAIN_STATS = stats.counter('main')
+"mails, bytes_read, candidates, parsed, failed, cache_hits"
 
 def w(msg:str):
     print(f"{msg}", file=sys.stderr)
@@ -93,228 +113,931 @@ strExtAtch        (v2.05より）添付ファイルを別ファイルに保存
                 区切られる。
 """
 
-class FolderIdxEntity(NamedTuple):
-    dwBodyPtr: int  #このメールアイテムのbmfファイル中の先頭からの位置
-    dwMsgID: str    #このメールアイテムをフォルダ中でユニークに識別する為のDWORD値
-    dwFileName: str # bmfファイルのファイル名部分
-    strSubject: str | bytes  #メールの件名
-    strFrom: str | bytes #メールの差出人
-    strTo: str | bytes #メールの宛先
-    strMsgId: str | bytes #メールのMessage-Idフィールド
-    strReferences: str #メールの参照先のMessage-Id（In-Reply-To,: int #Referenceフィールドから取得）
-    tSend: datetime.datetime #メールの送信日時（C言語のtime_t値）（Dateフィールドより取得）
-    tRecv: datetime.datetime #メールの配信日時（C言語のtime_t値）（Received: int #フィールドより取得）
-    tDnld: datetime.datetime #メールの受信日時（C言語のtime_t値）（受信時に決定）
-    dwSize: int #メールのサイズ（バイト数）
-    dwStatus: str #メールのステータスフラグ
-    nColor: str #カラーラベルのCOLORREF値
-    nPriority: int #５段階の重要度
-    dwParentID: str #スレッド表示の際の親アイテムのdwMsgID
-    strCharSet: str | None #このメールのキャラクタセット（空でも可）
-    str_: str #テンポラリ文字列（内容は不定、通常空）
-    strExtAtch: str | bytes # (v2.05より）添付ファイルを別ファイルに保存している場合
+def _idx_str(b:bytes, cells:List[bytes]):
+    return b.decode('ascii')
 
-def _load_folder_idx(folder_idx_path:str):
-    def _load():
-        with open(folder_idx_path, 'rb') as h:
-            return h.read()
+def _idx_str_or_bytes(b:bytes, cells:List[bytes]):
+    try:
+        return b.decode('ascii')
+    except UnicodeDecodeError as ex:
+        w('unicode decode error:' + str(ex))
+        return b
 
-    def s(b:bytes, encoding='ascii'):
-        return b.decode(encoding)
+IDX_TIME_MAX = 0xFFFFFFFF
+def _idx_time(b:bytes):
+    "time_t of tSend/tRecv/tDnld. a bad value raises ValueError when the line is loaded"
+    num = int(b, 16)
+    if not 0 <= num <= IDX_TIME_MAX:
+        raise ValueError(f'time_t out of range: {b!r}')
+    return num
 
-    def sb(b:bytes, encoding='ascii'):
-        try:
-            return b.decode(encoding)
-        except UnicodeDecodeError as ex:
-            w('unicode decode error:' + str(ex))
-            return b
-    
-    def to_date(b:bytes):
-        num = int(b, 16)
-        return datetime.datetime.fromtimestamp(num)
-
-    DECODE_MAP = {
-        'iso-2022-jp': 'cp932',
-    }
-    def decode(s: bytes, encoding:str | None):
-        try:
-            if encoding is None:
-                raise LookupError("encoding is null")
-            charset = DECODE_MAP.get(encoding.lower(), encoding)
-            return s.decode(charset, errors='ignore')
-        except LookupError:
+def _idx_hex(b:bytes, cells:List[bytes]):
+    return int(b, 16)
+
+def _idx_int(b:bytes, cells:List[bytes]):
+    return int(b)
+
+def _idx_charset(b:bytes, cells:List[bytes]):
+    return b.decode('ascii') if b else None
+
+IDX_DECODE_MAP = {
+    'iso-2022-jp': 'cp932',
+}
+_warned_encodings:Set[Optional[str]] = set()
+def _idx_decode(b:bytes, cells:List[bytes]):
+    encoding = _idx_charset(cells[16], cells)
+    try:
+        if encoding is None:
+            raise LookupError("encoding is null")
+        charset = IDX_DECODE_MAP.get(encoding.lower(), encoding)
+        return b.decode(charset, errors='ignore')
+    except LookupError:
+        # warn once per encoding, not per field
+        if encoding not in _warned_encodings:
+            _warned_encodings.add(encoding)
             w(f'unknown encoding : {encoding}')
-            for charset in ['cp932', 'iso2022-jp', 'euc-jp', 'utf-8']:
-                try:
-                    ret = s.decode(charset)
-                    w(f'using: {charset}')
-                    return ret
-                except UnicodeDecodeError:
-                    continue
-            return s
+        for charset in ['cp932', 'iso2022-jp', 'euc-jp', 'utf-8']:
+            try:
+                return b.decode(charset)
+            except UnicodeDecodeError:
+                continue
+        return b
+
+IDX_CELL_COUNT = 19
+def _idx_field(index:int, convert:Callable[[bytes, List[bytes]], Any]):
+    def get(self:'FolderIdxEntity'):
+        cells = self.line.split(b'\x01')
+        return convert(cells[index], cells)
+    return property(get)
+
+class FolderIdxEntity:
+    """
+    a line of Folder.idx.
+    only the raw line, the position and the times are kept. the other fields are decoded when they are accessed.
+    """
+    __slots__ = ('line', 'dwBodyPtr', 'dwSize', 'tSend', 'tRecv', 'tDnld', '_sender')
+
+    def __init__(self, line:bytes):
+        cell_count = line.count(b'\x01') + 1
+        if cell_count < IDX_CELL_COUNT:
+            raise ValueError(f'too few cells: {cell_count}')
+        cells = line.split(b'\x01', 12)
+        self.line:bytes     = line
+        self.dwBodyPtr:int  = int(cells[0], 16)  #このメールアイテムのbmfファイル中の先頭からの位置
+        self.dwSize:int     = int(cells[11], 16) #メールのサイズ（バイト数）
+        self.tSend:int      = _idx_time(cells[8])  #メールの送信日時（C言語のtime_t値）（Dateフィールドより取得）
+        self.tRecv:int      = _idx_time(cells[9])  #メールの配信日時（C言語のtime_t値）（Received フィールドより取得）
+        self.tDnld:int      = _idx_time(cells[10]) #メールの受信日時（C言語のtime_t値）（受信時に決定）
+        self._sender:Optional[str] = None
+
+    dwMsgID       = _idx_field(1,  _idx_str)          # str    #このメールアイテムをフォルダ中でユニークに識別する為のDWORD値
+    dwFileName    = _idx_field(2,  _idx_str)          # str # bmfファイルのファイル名部分
+    strSubject    = _idx_field(3,  _idx_decode)       # str | bytes  #メールの件名
+    strFrom       = _idx_field(4,  _idx_decode)       # str | bytes #メールの差出人
+    strTo         = _idx_field(5,  _idx_decode)       # str | bytes #メールの宛先
+    strMsgId      = _idx_field(6,  _idx_str_or_bytes) # str | bytes #メールのMessage-Idフィールド
+    strReferences = _idx_field(7,  _idx_str)          # str #メールの参照先のMessage-Id（In-Reply-To, Referenceフィールドから取得）
+    dwStatus      = _idx_field(12, _idx_str)          # str #メールのステータスフラグ
+    nColor        = _idx_field(13, _idx_str)          # str #カラーラベルのCOLORREF値
+    nPriority     = _idx_field(14, _idx_int)          # int #５段階の重要度
+    dwParentID    = _idx_field(15, _idx_str)          # str #スレッド表示の際の親アイテムのdwMsgID
+    strCharSet    = _idx_field(16, _idx_charset)      # str | None #このメールのキャラクタセット（空でも可）
+    str_          = _idx_field(17, _idx_str)          # str #テンポラリ文字列（内容は不定、通常空）
+    strExtAtch    = _idx_field(18, _idx_decode)       # str | bytes # (v2.05より）添付ファイルを別ファイルに保存している場合
+
+    @property
+    def sender(self):
+        "the address of strFrom. decoded once, and kept in the Folder.idx cache"
+        if self._sender is None:
+            from_ = self.strFrom
+            if not isinstance(from_, str):
+                from_ = from_.decode('ascii', errors='ignore')
+            self._sender = sys.intern(r_pay.sender_address(from_))
+        return self._sender
+
+    @classmethod
+    def from_values(cls, line:bytes, body_ptr:int, size:int, t_send:int, t_recv:int, t_dnld:int, sender:str):
+        "without validating the line. for the Folder.idx cache"
+        self = cls.__new__(cls)
+        self.line      = line
+        self.dwBodyPtr = body_ptr
+        self.dwSize    = size
+        self.tSend     = t_send
+        self.tRecv     = t_recv
+        self.tDnld     = t_dnld
+        self._sender   = sender
+        return self
+
+    def __repr__(self):
+        return f'FolderIdxEntity({self.line!r})'
+
+class IdxError(NamedTuple):
+    path: str
+    line_no: int
+    message: str
+folder_idx_errors: List[IdxError] = []
+"malformed Folder.idx lines. they are skipped and reported at the end."
+
+# cache of the parsed Folder.idx (--idx-cache)
+#   header: magic, mtime_ns, size (of Folder.idx), count
+#   columns: int64[count] dwBodyPtr, dwSize, end offset of the line in the blob, tSend, tRecv, tDnld, sender code
+#   blob: raw lines
+#   senders: the distinct sender addresses, NUL terminated utf-8. indexed by the sender code
+IDX_CACHE_MAGIC  = b'BKIDXC\x00\x03'
+IDX_CACHE_COLUMNS = 7
+IDX_CACHE_HEADER = struct.Struct('<8sqqq')
+
+def _idx_cache_path(cache_dir:str, folder_idx_path:str):
+    name = hashlib.sha1(os.path.abspath(folder_idx_path).encode('utf-8')).hexdigest()
+    return join_path(cache_dir, f'{name}.idxc')
+
+def _read_idx_cache(cache_path:str, idx_stat:os.stat_result) -> Optional[List[FolderIdxEntity]]:
+    try:
+        with open(cache_path, 'rb') as h:
+            data = h.read()
+    except FileNotFoundError:
+        return None
+    if len(data) < IDX_CACHE_HEADER.size:
+        return None
+    magic, mtime_ns, size, count = IDX_CACHE_HEADER.unpack_from(data)
+    if (magic, mtime_ns, size) != (IDX_CACHE_MAGIC, idx_stat.st_mtime_ns, idx_stat.st_size):
+        return None
+
+    pos = IDX_CACHE_HEADER.size
+    if len(data) < pos + 8 * IDX_CACHE_COLUMNS * count:
+        return None
+    columns = []
+    for _ in range(IDX_CACHE_COLUMNS):
+        column = array.array('q')
+        column.frombytes(data[pos:pos+column.itemsize*count])
+        if sys.byteorder != 'little':
+            column.byteswap()
+        pos += column.itemsize * count
+        columns.append(column)
+    body_ptrs, sizes, ends, t_sends, t_recvs, t_dnlds, sender_codes = columns
+    blob_end = pos + (ends[-1] if count else 0)
+    # a truncated file is rebuilt
+    if count and (blob_end >= len(data) or not data.endswith(b'\x00')):
+        return None
+    senders = data[blob_end:-1].decode('utf-8', 'surrogateescape').split('\x00') if count else []
+    if count and max(sender_codes) >= len(senders):
+        return None
+
+    entities = []
+    start = pos
+    from_values = FolderIdxEntity.from_values
+    for body_ptr, size, end, t_send, t_recv, t_dnld, sender_code in zip(*columns):
+        end += pos
+        entities.append(from_values(data[start:end], body_ptr, size, t_send, t_recv, t_dnld, senders[sender_code]))
+        start = end
+    return entities
 
-    def _parse(line:bytes, lineNo:int):
+def _write_idx_cache(cache_path:str, idx_stat:os.stat_result, entities:List[FolderIdxEntity]):
+    senders: Dict[str, int] = {}
+    columns = [
+        array.array('q', (e.dwBodyPtr for e in entities)),
+        array.array('q', (e.dwSize for e in entities)),
+        array.array('q', itertools.accumulate(len(e.line) for e in entities)),
+        array.array('q', (e.tSend for e in entities)),
+        array.array('q', (e.tRecv for e in entities)),
+        array.array('q', (e.tDnld for e in entities)),
+        array.array('q', (senders.setdefault(e.sender, len(senders)) for e in entities)),
+    ]
+    tmp_path = f'{cache_path}.tmp'
+    with open(tmp_path, 'wb') as h:
+        h.write(IDX_CACHE_HEADER.pack(IDX_CACHE_MAGIC, idx_stat.st_mtime_ns, idx_stat.st_size, len(entities)))
+        for column in columns:
+            if sys.byteorder != 'little':
+                column.byteswap()
+            h.write(column.tobytes())
+        for entity in entities:
+            h.write(entity.line)
+        h.write(''.join(f'{sender}\x00' for sender in senders).encode('utf-8', 'surrogateescape'))
+    os.replace(tmp_path, cache_path)
+
+def _parse_folder_idx(folder_idx_path:str, idx_file:bytes):
+    entities = []
+    lines = idx_file.splitlines()
+    for i, line in enumerate(lines[1:]):
         try:
-            cells = line.split(b'\x01')
-            # str #このメールのキャラクタセット（空でも可）
-            char_set = s(cells[16]) if cells[16] else None
-
-            # print(len(cells))
-            # print(cells)
-            return FolderIdxEntity(
-                int(cells[0], 16),  # int  #このメールアイテムのbmfファイル中の先頭からの位置
-                s(cells[1]), # str    #このメールアイテムをフォルダ中でユニークに識別する為のDWORD値,
-                s(cells[2]), # str # bmfファイルのファイル名部分,
-                decode(cells[3], char_set), # str #メールの件名
-                decode(cells[4], char_set), # str #メールの差出人
-                decode(cells[5], char_set), # str #メールの宛先
-                sb(cells[6]), # str #メールのMessage-Idフィールド
-                s(cells[7]), # str #メールの参照先のMessage-Id（In-Reply-To, Referenceフィールドから取得）
-                to_date(cells[8]),  # datetime.datetime #メールの送信日時（C言語のtime_t値）（Dateフィールドより取得）
-                to_date(cells[9]),  # datetime.datetime #メールの配信日時（C言語のtime_t値）（Received フィールドより取得）
-                to_date(cells[10]), # datetime.datetime #メールの受信日時（C言語のtime_t値）（受信時に決定）
-                int(cells[11], 16), # int #メールのサイズ（バイト数）
-                s(cells[12]), # int #メールのステータスフラグ
-                s(cells[13]), # str #カラーラベルのCOLORREF値
-                int(cells[14]), # int #５段階の重要度
-                s(cells[15]), # str #スレッド表示の際の親アイテムのdwMsgID
-                char_set, #cells[16], # str #このメールのキャラクタセット（空でも可）
-                s(cells[17]), # str #テンポラリ文字列（内容は不定、通常空）
-                decode(cells[18], char_set) # str # (v2.05より）添付ファイルを別ファイルに保存している場合
-            )
+            entities.append(FolderIdxEntity(line))
         except Exception as ex:
-            e(f'unexpected exception! : file={folder_idx_path} / lineNo:{lineNo}')
-            pdb.set_trace()
-            raise
+            line_no = i + 2 # 1 origin, and the header line
+            w(f'malformed line in Folder.idx, skipped: {folder_idx_path}:{line_no}: {ex}')
+            folder_idx_errors.append(IdxError(folder_idx_path, line_no, str(ex)))
+    return entities
 
-    idx_file = _load()
-    lines = idx_file.splitlines()
-    return [ _parse(line, i) for i, line in enumerate(lines[1:]) ]
+@stats.timed('idx')
+def _load_folder_idx(folder_idx_path:str):
+    def read_idx():
+        with open(folder_idx_path, 'rb') as h:
+            return h.read(), os.fstat(h.fileno())
+
+    cache_dir = argv.idx_cache_dir if argv is not None else None
+    if cache_dir is None:
+        return _parse_folder_idx(folder_idx_path, read_idx()[0])
+
+    # Folder.idx is read only when the cache misses
+    cache_path = _idx_cache_path(cache_dir, folder_idx_path)
+    entities   = _read_idx_cache(cache_path, os.stat(folder_idx_path))
+    if entities is not None:
+        return entities
+
+    idx_file, idx_stat = read_idx()
+    error_count = len(folder_idx_errors)
+    entities    = _parse_folder_idx(folder_idx_path, idx_file)
+    # not cached while there are malformed lines, so they are reported every time
+    if len(folder_idx_errors) == error_count:
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+            _write_idx_cache(cache_path, idx_stat, entities)
+        except OSError as ex:
+            w(f'failed to write Folder.idx cache: {cache_path}: {ex}')
+    return entities
 
 def _fitler_idx_entity(entities: List[FolderIdxEntity], since: Optional[datetime.datetime], until: Optional[datetime.datetime]):
     if since is None and until is None:
         return entities
 
-    if since is None:
-        since = datetime.datetime.min
+    # tSend is time_t. the dates are local time, same as datetime.fromtimestamp()
+    lo = since.timestamp() if since is not None else float('-inf')
+    hi = (until + datetime.timedelta(days=1)).timestamp() if until is not None else float('inf')
 
-    if until is None:
-        until = datetime.datetime.max
-    else:
-        until = until + datetime.timedelta(days=1)
+    return [ e for e in entities if lo <= e.tSend <= hi ]
+
+def _filter_rakuten_pay_candidate(entities: List[FolderIdxEntity]):
+    """
+    drop the entities which are obviously not rakuten pay mails, using From/Subject in Folder.idx.
+    """
+    def to_str(v: str | bytes):
+        return v if isinstance(v, str) else v.decode('ascii', errors='ignore')
+
+    def is_candidate(e: FolderIdxEntity):
+        # the sender is in the Folder.idx cache. the subject is decoded only for the rakuten pay senders
+        return r_pay.is_rakuten_pay_sender(e.sender) and r_pay.is_rakuten_pay_mail(e.sender, to_str(e.strSubject))
+
+    return list(filter(is_candidate, entities))
 
-    def is_include(e: FolderIdxEntity):
-        return since <= e.tSend <= until
+# =====================================
+# incremental run
+# =====================================
+class FolderWatermark(NamedTuple):
+    mtime: float    # Folder.idx
+    size: int       # Folder.idx
+    tDnld: float    # newest tDnld (time_t)
+    dwMsgID: int    # newest dwMsgID at tDnld
+    retry: Tuple[int, ...] = ()
+    "dwMsgID of the mails failed to parse. they are parsed again when the parser is updated"
+    retry_version: int = 0
+    "r_pay.PARSER_VERSION the retry mails failed with"
+
+def _load_watermarks(state_path:str) -> Dict[str, FolderWatermark]:
+    try:
+        with open(state_path, encoding='utf-8') as h:
+            state = json.load(h)
+    except FileNotFoundError:
+        return {}
+    return { idx_path: FolderWatermark(*v) for idx_path, v in state.items() }
 
-    return list(filter(is_include, entities))
+def _save_watermarks(state_path:str, watermarks: Dict[str, FolderWatermark]):
+    tmp_path = f'{state_path}.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as h:
+        json.dump({ idx_path: list(v) for idx_path, v in watermarks.items() }, h, indent=1)
+    os.replace(tmp_path, state_path)
+
+def _is_retry_due(mark:FolderWatermark):
+    "a failed mail fails again with the same parser"
+    return bool(mark.retry) and mark.retry_version != r_pay.PARSER_VERSION
+
+def _is_folder_unchanged(idx_stat:os.stat_result, mark:Optional[FolderWatermark]):
+    return mark is not None and mark.mtime == idx_stat.st_mtime and mark.size == idx_stat.st_size and not _is_retry_due(mark)
+
+def _entity_order(e: FolderIdxEntity):
+    return (e.tDnld, int(e.dwMsgID, 16))
+
+def _filter_new_entity(entities: List[FolderIdxEntity], mark:Optional[FolderWatermark]):
+    "drop the entities downloaded before the last run, except the failed ones when the parser is updated"
+    if mark is None:
+        return entities
+    last  = (mark.tDnld, mark.dwMsgID)
+    retry = set(mark.retry) if _is_retry_due(mark) else set()
+    return [ e for e in entities if _entity_order(e) > last or int(e.dwMsgID, 16) in retry ]
+
+def _make_watermark(idx_stat:os.stat_result, entities: List[FolderIdxEntity], mark:Optional[FolderWatermark]):
+    orders = list(map(_entity_order, entities))
+    if mark is not None:
+        orders.append((mark.tDnld, mark.dwMsgID))
+    newest = max(orders, default=(0, 0))
+    # the failed mails not retried in this run are kept
+    retry = mark.retry if mark is not None and not _is_retry_due(mark) else ()
+    return FolderWatermark(idx_stat.st_mtime, idx_stat.st_size, *newest, tuple(retry), r_pay.PARSER_VERSION)
+
+def _retry_failed_entities(failed:Iterable[Tuple[str, Optional[str]]]):
+    "keep the candidates failed to parse in the new watermarks. matched by the bmf file and the Message-ID"
+    def msgid_of(e: FolderIdxEntity):
+        v = e.strMsgId
+        return (v if isinstance(v, str) else v.decode('ascii', errors='ignore')).strip()
+
+    failed_keys = { (path, str(msgid).strip()) for path, msgid in failed if msgid }
+    for mark_key, (dir_name, entities) in watermark_candidates.items():
+        mark  = new_watermarks[mark_key]
+        retry = set(mark.retry)
+        retry.update(
+            int(e.dwMsgID, 16) for e in entities
+            if (_bmf_path(dir_name, e.dwFileName), msgid_of(e)) in failed_keys
+        )
+        new_watermarks[mark_key] = mark._replace(retry=tuple(sorted(retry)))
 
 # =====================================
 END_OF_EMAIL = b'\r\n.\r\n'
 END_OF_EMAIL_LENGTH = len(END_OF_EMAIL)
 
-def _find_eoe_index(mail:bytes, start_index:int):
-    for i in range(start_index, len(mail)):
-        if mail[i:i+END_OF_EMAIL_LENGTH] == END_OF_EMAIL:
-            return i
-    return None
+def _find_eoe_index(mail:bytes | mmap.mmap, start_index:int):
+    i = mail.find(END_OF_EMAIL, start_index)
+    return None if i < 0 else i
 
 def _split_becky_mailfile(bkl_filepath:str):
+    """
+    yields each mail as a zero-copy memoryview over the memory-mapped file.
+    the views are valid only until the generator is closed.
+    """
     with open(bkl_filepath, "rb") as h:
-        file = h.read()
-
-    start_index = 0
-    eoe_index   = _find_eoe_index(file, start_index)
-    while eoe_index is not None:
-        yield file[start_index: eoe_index+END_OF_EMAIL_LENGTH]
-        start_index = eoe_index + END_OF_EMAIL_LENGTH
-        eoe_index   = _find_eoe_index(file, start_index)
-    rem = file[start_index:]
-    if len(rem) > 0:
-        yield file[start_index:]
-
-def parse_mail(bmf_path:str):
+        if os.fstat(h.fileno()).st_size == 0:
+            return
+        file = mmap.mmap(h.fileno(), 0, access=mmap.ACCESS_READ)
+
+    view = memoryview(file)
+    try:
+        start_index = 0
+        with stats.stage('split'):
+            eoe_index = _find_eoe_index(file, start_index)
+        while eoe_index is not None:
+            MAIN_STATS['bytes_read'] += eoe_index + END_OF_EMAIL_LENGTH - start_index
+            yield view[start_index: eoe_index+END_OF_EMAIL_LENGTH]
+            start_index = eoe_index + END_OF_EMAIL_LENGTH
+            with stats.stage('split'):
+                eoe_index = _find_eoe_index(file, start_index)
+        if start_index < len(file):
+            MAIN_STATS['bytes_read'] += len(file) - start_index
+            yield view[start_index:]
+    finally:
+        view.release()
+        try:
+            file.close()
+        except BufferError:
+            # a caller still holds a slice. the map is released by GC.
+            pass
+
+def _coalesce_entities(entities:List[FolderIdxEntity], gap:int, span:int):
+    "group the sorted entities so that each group is read by one read() call"
+    groups: List[List[FolderIdxEntity]] = []
+    for entity in entities:
+        if groups:
+            group = groups[-1]
+            start = group[0].dwBodyPtr
+            end   = group[-1].dwBodyPtr + group[-1].dwSize
+            if entity.dwBodyPtr - end <= gap and entity.dwBodyPtr + entity.dwSize - start <= span:
+                group.append(entity)
+                continue
+        groups.append([entity])
+    return groups
+
+def _read_indexed_mails(bmf_path:str, entities:List[FolderIdxEntity], lookup:Optional[parse_cache.ParseCache], gap:Optional[int]=None, span:int=0):
+    """
+    yields only the mails listed in Folder.idx, seeking to dwBodyPtr and reading dwSize bytes.
+    yields (cache key, mail). the mail is None when it is in the parse cache.
+    lookup: the parse cache to look up. a sqlite connection can't be shared with the read-ahead thread.
+    gap, span: the mails closer than gap bytes are read together, up to span bytes. None: one read() per mail
+    """
+    with open(bmf_path, "rb") as h:
+        entities = sorted(entities, key=lambda e: e.dwBodyPtr)
+        groups   = [ [e] for e in entities ] if gap is None else _coalesce_entities(entities, gap, span)
+        for group in groups:
+            start = group[0].dwBodyPtr
+            block = None
+            for entity in group:
+                key = None
+                if lookup is not None:
+                    key = parse_cache.index_key(bmf_path, entity.dwBodyPtr, entity.dwSize, entity.strMsgId)
+                    if key in lookup:
+                        yield key, None
+                        continue
+
+                if block is None:
+                    with stats.stage('read'):
+                        h.seek(start)
+                        block = h.read(group[-1].dwBodyPtr + group[-1].dwSize - start)
+                    MAIN_STATS['bytes_read'] += len(block)
+                if len(group) == 1:
+                    mail_raw = block
+                else:
+                    offset   = entity.dwBodyPtr - start
+                    mail_raw = block[offset:offset+entity.dwSize]
+                if len(mail_raw) < entity.dwSize:
+                    w(f'bmf file is shorter than Folder.idx says...: {bmf_path}:{entity.dwMsgID}')
+                yield key, mail_raw
+
+def _scan_mails(bmf_path:str):
+    for mail_raw in _split_becky_mailfile(bmf_path):
+        yield None, mail_raw
+
+def _parse_mail_raws(bmf_path:str, mail_raws:Iterable[Tuple[Optional[str], bytes | memoryview | None]], sink:Optional[quarantine.FailureBuffer]=None):
+    "sink: where the failed mails go. None: the global failures"
+    sink = sink if sink is not None else failures
     msgid = None
     mail  = None
     try:
-        for mail_raw in _split_becky_mailfile(bmf_path):
+        for key, mail_raw in mail_raws:
+            MAIN_STATS['mails'] += 1
+            if cache is not None:
+                with stats.stage('cache'):
+                    if key is None:
+                        key = parse_cache.raw_key(mail_raw)
+                    hit, pay_mail = cache.get(key)
+                if hit:
+                    MAIN_STATS['cache_hits'] += 1
+                    if pay_mail:
+                        yield pay_mail
+                    continue
+
+            with stats.stage('peek'):
+                candidate = r_pay.peek_rakuten_pay_mail(mail_raw)
+            if not candidate:
+                if cache is not None:
+                    cache.put(key, None)
+                continue
+            MAIN_STATS['candidates'] += 1
+            mail_raw = bytes(mail_raw)
             try:
-                mail  = email.message_from_bytes(mail_raw)
+                with stats.stage('mime'):
+                    mail  = email.message_from_bytes(mail_raw)
                 msgid = mail['Message-ID']
 
-                pay_mail = r_pay.parse_email(mail)
+                with stats.stage('parse'):
+                    pay_mail = r_pay.parse_email(mail)
                 if pay_mail:
+                    MAIN_STATS['parsed'] += 1
                     yield pay_mail
                     if pay_mail.has_error:
-                        raise r_pay.UnexcpectedRakutenPayMailException()
+                        raise r_pay.error_exception(mail, pay_mail)
+                if cache is not None:
+                    cache.put(key, pay_mail)
             except r_pay.UnexcpectedRakutenPayMailException as ex:
+                MAIN_STATS['failed'] += 1
                 basename = os.path.basename(bmf_path)
-                w(f'Unexpected rakute pay mail format:{basename}:{msgid}:{traceback.format_exc()}')
-
-                # remove invalid chars in windows path
-                for c in '\\/:*?"<>|':
-                    msgid = msgid.replace(c, '')
-                _dump_mail(mail_raw, _dump_exception(ex), f"{basename}_{msgid}")
+                w(f'Unexpected rakute pay mail format:{basename}:{msgid}')
+                # the trace is formatted only when the mail is stored as a sample
+                if sink is not None:
+                    sink.capture(bmf_path, msgid, mail_raw, ex)
                 continue
     except FileNotFoundError:
         w(f'bmf file not found...: {bmf_path}')
     except Exception as ex:
         print(f"{bmf_path}:{msgid}:{ex}")
         raise
+    finally:
+        if cache is not None:
+            cache.commit()
+
+def parse_mail(bmf_path:str, sink:Optional[quarantine.FailureBuffer]=None):
+    "parse all mails in the bmf file"
+    return _parse_mail_raws(bmf_path, _scan_mails(bmf_path), sink)
+
+def parse_indexed_mail(bmf_path:str, entities:List[FolderIdxEntity], sink:Optional[quarantine.FailureBuffer]=None):
+    "parse only the mails of the given Folder.idx entities"
+    return _parse_mail_raws(bmf_path, _read_indexed_mails(bmf_path, entities, cache), sink)
+
+class ParseTask(NamedTuple):
+    bmf_path: str
+    entities: Optional[List[FolderIdxEntity]]
+    "None: scan the whole bmf file"
+
+def _period():
+    return mailsource.Period(argv.since, argv.until)
+
+def _parse_task(task:ParseTask | mailsource.SourceTask, sink:Optional[quarantine.FailureBuffer]=None):
+    if isinstance(task, mailsource.SourceTask):
+        return _parse_mail_raws(task.path, task.read(_period(), cache), sink)
+    if task.entities is None:
+        return parse_mail(task.bmf_path, sink)
+    return parse_indexed_mail(task.bmf_path, task.entities, sink)
+
+def _init_worker(params:CLIParameter, stats_enabled:bool):
+    global argv, cache
+    argv = params
+    if params.cache_path is not None:
+        cache = parse_cache.ParseCache(params.cache_path)
+    stats.ENABLED = stats_enabled
+
+def _parse_task_worker(task:ParseTask, group_by:Optional[Tuple[str, ...]]=None):
+    """
+    runs in a worker process.
+    warnings and failed mails are returned to the parent instead of being written here,
+    so that they don't get mixed with the other workers.
+    group_by: return a partial summary.Summary instead of the mails
+    """
+    failed = quarantine.FailureBuffer(argv.failure_samples)
+    stats.reset()
+    with contextlib.redirect_stderr(io.StringIO()) as err:
+        if group_by is None:
+            result = list(_parse_task(task, failed))
+        else:
+            result = summary.Summary(group_by).update(_parse_task(task, failed))
+    return result, err.getvalue(), failed, stats.snapshot()
+
+TASK_CHUNK_SIZE = 256
+def _split_task(task:ParseTask | mailsource.SourceTask):
+    "split a task into mail ranges so that a big bmf file is parsed by several workers"
+    if isinstance(task, mailsource.SourceTask):
+        # already split by mailsource.enumerate_tasks()
+        return [task]
+    if task.entities is None:
+        return [task]
+    entities = sorted(task.entities, key=lambda e: e.dwBodyPtr)
+    return [ ParseTask(task.bmf_path, entities[i:i+TASK_CHUNK_SIZE]) for i in range(0, len(entities), TASK_CHUNK_SIZE) ]
+
+def _task_path(task:ParseTask | mailsource.SourceTask):
+    return task.path if isinstance(task, mailsource.SourceTask) else task.bmf_path
+
+def _task_bytes(task:ParseTask | mailsource.SourceTask):
+    "size of the mails to be read. for the progress"
+    if isinstance(task, mailsource.SourceTask):
+        return task.size
+    if task.entities is not None:
+        return sum(e.dwSize for e in task.entities)
+    try:
+        return os.path.getsize(task.bmf_path)
+    except OSError:
+        return 0
+
+def _run_tasks_parallel(tasks:List[ParseTask], workers:int, group_by:Optional[Tuple[str, ...]]=None):
+    "yields the result of each task. see _parse_task_worker()"
+    tasks    = sum(map(_split_task, tasks), [])
+    progress = stats.Progress(sum(map(_task_bytes, tasks)), len(tasks))
+    worker   = functools.partial(_parse_task_worker, group_by=group_by)
+    with concurrent.futures.ProcessPoolExecutor(workers, initializer=_init_worker, initargs=(argv, stats.ENABLED)) as pool:
+        # map() keeps the task order, so the result is the same as the serial run.
+        for task, (result, err, failed, snap) in zip(tasks, pool.map(worker, tasks)):
+            print(err, end='', file=sys.stderr, flush=True)
+            if failures is not None:
+                failures.merge(failed)
+            stats.merge(snap)
+            progress.update(_task_bytes(task))
+            yield result
+    progress.finish()
+
+def _parse_tasks_parallel(tasks:List[ParseTask], workers:int):
+    for pay_mails in _run_tasks_parallel(tasks, workers):
+        yield from pay_mails
+
+# =====================================
+# read-ahead (--prefetch)
+# =====================================
+_END_OF_TASK = None
+PREFETCH_GAP = 64 * 1024
+"the mails closer than this are read with one read() call by the read-ahead thread"
+
+def _read_task_mails(task:ParseTask | mailsource.SourceTask, lookup:Optional[parse_cache.ParseCache]):
+    if isinstance(task, mailsource.SourceTask):
+        return ( (key, None if raw is None else bytes(raw)) for key, raw in task.read(_period(), lookup) )
+    if task.entities is not None:
+        return _read_indexed_mails(task.bmf_path, task.entities, lookup, PREFETCH_GAP, argv.prefetch_bytes)
+    # copying the bytes out of the map makes the page faults happen in the read-ahead thread
+    return ( (key, bytes(view)) for key, view in _scan_mails(task.bmf_path) )
+
+def _prefetch_tasks(tasks:List[ParseTask | mailsource.SourceTask], depth:int, prefetch_bytes:int):
+    """
+    yields (task, mails of the task). the mails are read by a background thread
+    in batches of about prefetch_bytes, and at most depth batches wait in the queue.
+    so the next bmf files are read while the current one is parsed.
+    the mails of a task must be consumed (or closed) before the next task is taken.
+    """
+    q: queue.Queue = queue.Queue(maxsize=depth)
+    stop = threading.Event()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def reader():
+        lookup = None
+        try:
+            if argv.cache_path is not None:
+                lookup = parse_cache.ParseCache(argv.cache_path)
+            for task in tasks:
+                batch: List[Any] = []
+                size = 0
+                try:
+                    for key, mail_raw in _read_task_mails(task, lookup):
+                        batch.append((key, mail_raw))
+                        size += len(mail_raw) if mail_raw is not None else 0
+                        if size >= prefetch_bytes:
+                            if not put(batch):
+                                return
+                            batch = []
+                            size  = 0
+                except Exception as ex:
+                    # raised in the consumer, the same as the serial run
+                    batch.append(ex)
+                if batch and not put(batch):
+                    return
+                if not put(_END_OF_TASK):
+                    return
+        except Exception as ex:
+            put([ex])
+        finally:
+            if lookup is not None:
+                lookup.close()
+
+    def task_mails():
+        done = False
+        try:
+            while True:
+                batch = q.get()
+                if batch is _END_OF_TASK:
+                    done = True
+                    return
+                for item in batch:
+                    if isinstance(item, Exception):
+                        raise item
+                    yield item
+        finally:
+            # skip the rest of the task when the consumer stopped early
+            while not done and not stop.is_set():
+                try:
+                    done = q.get(timeout=0.1) is _END_OF_TASK
+                except queue.Empty:
+                    continue
+
+    thread = threading.Thread(target=reader, name='becky-prefetch', daemon=True)
+    thread.start()
+    try:
+        for task in tasks:
+            mails = task_mails()
+            yield task, mails
+            mails.close()
+    finally:
+        stop.set()
+        thread.join()
+
+def _bmf_path(dir_name:str, bmf_filename:str):
+    return join_path(dir_name, f"{bmf_filename:>08}.bmf")
+
+def _enumerate_tasks(mail_box_path:str, deduper:Optional[dedupe.Deduper]=None) -> List[ParseTask | mailsource.SourceTask]:
+    "deduper: drop the entities whose Message-ID is already seen, before reading the bmf files"
+    if argv.mail_format != mailsource.BECKY:
+        return mailsource.enumerate_tasks(mail_box_path, argv.mail_format)
 
-def get_rakuten_pay_mails(mail_box_path:str):
     def enumerate_bmf_files(idx_filepath: str):
         print(f"found: {idx_filepath}", end='', file=sys.stderr)
         idx_fullpath = join_path(mail_box_path, idx_filepath)
+        if watermarks is not None:
+            mark_key = idx_filepath.replace(os.sep, '/')
+            mark     = watermarks.get(mark_key)
+            idx_stat = os.stat(idx_fullpath)
+            if _is_folder_unchanged(idx_stat, mark):
+                print(' / unchanged', file=sys.stderr)
+                return []
+
         entities = _load_folder_idx(idx_fullpath)
         entities = _fitler_idx_entity(entities, argv.since, argv.until)
-        print(f' / {len(entities)} entities', file=sys.stderr)
+        if watermarks is not None:
+            entities = _filter_new_entity(entities, mark)
+            new_watermarks[mark_key] = _make_watermark(idx_stat, entities, mark)
+        print(f' / {len(entities)} entities', end='', file=sys.stderr)
+        entities = _filter_rakuten_pay_candidate(entities)
+        print(f' / {len(entities)} candidates', end='', file=sys.stderr)
+        if deduper is not None:
+            count    = len(entities)
+            entities = [ e for e in entities if not deduper.is_duplicate_msgid(e.strMsgId) ]
+            if len(entities) < count:
+                print(f' / {count - len(entities)} duplicates', end='', file=sys.stderr)
+        print(file=sys.stderr)
 
-        dir_name          = os.path.dirname(idx_fullpath)
-        bmf_filename_list = set(e.dwFileName for e in entities)
-        return [ join_path(mail_box_path, dir_name, f"{bmf_filename:>08}.bmf") for bmf_filename in bmf_filename_list ]
+        dir_name    = os.path.dirname(idx_fullpath)
+        if watermarks is not None:
+            watermark_candidates[mark_key] = (dir_name, entities)
+        bmf_entities: Dict[str, List[FolderIdxEntity]] = {}
+        for entity in entities:
+            bmf_entities.setdefault(entity.dwFileName, []).append(entity)
+        return [
+            ParseTask(_bmf_path(dir_name, bmf_filename), None if argv.full_scan else bmf_entities[bmf_filename])
+            for bmf_filename in sorted(bmf_entities)
+        ]
 
     folder_idx_list = glob.glob('**/Folder.idx', root_dir=mail_box_path, recursive=True)
-    files           = sum(map(enumerate_bmf_files, folder_idx_list), [])
-    file_count      = len(files)
+    return sum(map(enumerate_bmf_files, folder_idx_list), [])
+
+def _parse_tasks_serial(tasks:List[ParseTask]):
+    if argv.prefetch_depth > 0:
+        progress = stats.Progress(sum(map(_task_bytes, tasks)), len(tasks))
+        for task, mails in _prefetch_tasks(tasks, argv.prefetch_depth, argv.prefetch_bytes):
+            yield from _parse_mail_raws(_task_path(task), mails)
+            progress.update(_task_bytes(task))
+        progress.finish()
+    else:
+        progress = stats.Progress(sum(map(_task_bytes, tasks)), len(tasks))
+        for task in tasks:
+            yield from _parse_task(task)
+            progress.update(_task_bytes(task))
+        progress.finish()
+
+def _dedupe_by_idx():
+    "the Message-IDs are checked with Folder.idx. a full scan reads all mails in the bmf files anyway"
+    return argv.mail_format == mailsource.BECKY and not argv.full_scan
 
-    for i, bmf_file in enumerate(files):
-        basename = os.path.basename(bmf_file)
-        print(f'{basename} ({i}/{file_count})', file=sys.stderr, flush=True)
-        bmf_path = os.path.join(mail_box_path, bmf_file)
-        yield from parse_mail(bmf_path)
+def _parse_tasks(tasks:List[ParseTask | mailsource.SourceTask]):
+    if argv.workers > 1:
+        return _parse_tasks_parallel(tasks, argv.workers)
+    return _parse_tasks_serial(tasks)
+
+def get_rakuten_pay_mails(mail_box_path:str):
+    deduper = dedupe.Deduper(argv.dedupe_level)
+    by_idx  = _dedupe_by_idx()
+    tasks   = _enumerate_tasks(mail_box_path, deduper if by_idx else None)
+    yield from deduper.filter(_parse_tasks(tasks), by_msgid=not by_idx)
+
+def summarize_rakuten_pay_mails(mail_box_path:str, group_by:Sequence[str]):
+    """
+    fold the mails into a summary.Summary as they are parsed. the mails are not kept.
+    the worker processes send their partial summaries, which are merged here.
+    """
+    ret     = summary.Summary(group_by)
+    deduper = dedupe.Deduper(argv.dedupe_level)
+    by_idx  = _dedupe_by_idx()
+    tasks   = _enumerate_tasks(mail_box_path, deduper if by_idx else None)
+    # the parsed mails are deduped here. the workers can't do it with their partial summaries
+    dedupe_mails = argv.dedupe_level == dedupe.RECEIPT or (argv.dedupe_level == dedupe.MSGID and not by_idx)
+    if argv.workers > 1 and not dedupe_mails:
+        for part in _run_tasks_parallel(tasks, argv.workers, ret.group_by):
+            ret.merge(part)
+    else:
+        ret.update(deduper.filter(_parse_tasks(tasks), by_msgid=not by_idx))
+    return ret
 
 # === main ===
 def get_cli_option():
     p = argparse.ArgumentParser()
-    p.add_argument('mail_box_path', help='specify the directory to *.bmf files.', type=str)
+    p.add_argument('mail_box_path', help='specify the directory to *.bmf files. an mbox file, a Maildir or a directory of *.eml files are read, too', type=str)
+    p.add_argument('--format', help='format of the mailbox. auto: mbox for a file, maildir for a directory with cur/ and new/, becky when Folder.idx is found, eml otherwise', choices=('auto',) + mailsource.FORMATS, default='auto')
     p.add_argument('-s', '--since', help='ex) 2025-01-01', type=str)
     p.add_argument('-u', '--until', help='ex) 2025-01-01', type=str)
-    return p.parse_args()
+    p.add_argument('--full-scan', help='read whole *.bmf files instead of the ranges recorded in Folder.idx', action='store_true')
+    p.add_argument('--dedupe', help='msgid: parse the same Message-ID once. receipt: and write the same receipt number of a template once. off: keep the duplicates', choices=dedupe.LEVELS, default=dedupe.MSGID)
+    p.add_argument('-j', '--workers', help='number of worker processes', type=int, default=1)
+    p.add_argument('--cache', help='sqlite file to keep the parse results between runs', type=str)
+    p.add_argument('--idx-cache', help='directory to keep the parsed Folder.idx files between runs', type=str)
+    p.add_argument('--state', help='json file to remember the last run. only newly downloaded mails are parsed, and the failed ones again when the parser is updated. not with --since/--until/--full-scan', type=str)
+    p.add_argument('--merge', help='merge the result into this csv file instead of printing it', type=str)
+    p.add_argument('-o', '--output', help='write the csv to this file instead of stdout', type=str)
+    p.add_argument('--summary', help=f'print the totals grouped by these keys instead of the payments. comma separated list of {",".join(summary.GROUP_KEYS)}', type=str)
+    p.add_argument('--columnar', help='write the payments to this .npz (or .parquet/.arrow with pyarrow) file too. see analytics.py', type=str)
+    p.add_argument('--no-sort', help='write each row as soon as it is parsed, without sorting by DateTime', action='store_true')
+    p.add_argument('--prefetch', help='number of batches read ahead by a background thread while parsing. 0: off', type=int, default=0)
+    p.add_argument('--prefetch-size', help='bytes of a read-ahead batch', type=int, default=4 * 1024 * 1024)
+    p.add_argument('--sort-buffer', help='number of rows sorted in memory. the rest are spilled to temporary files', type=int, default=100000)
+    p.add_argument('--failures', help='zip file to store the samples of the mails failed to parse', type=str, default='failures.zip')
+    p.add_argument('--failure-samples', help='number of the mails stored per kind of failure', type=int, default=3)
+    p.add_argument('--stats', help='write the per-stage timings and the counters to this json file', type=str)
+    p.add_argument('--profile', help='write cProfile stats of the main process to this file', type=str)
+    p.add_argument('--tracemalloc', help='add the memory allocations of the main process to the --stats report', action='store_true')
+    opt = p.parse_args()
+    if opt.merge and opt.no_sort:
+        p.error('--merge requires sorted rows')
+    if opt.tracemalloc and not opt.stats:
+        p.error('--tracemalloc requires --stats')
+    if opt.summary and (opt.merge or opt.columnar):
+        p.error('--summary writes only the totals')
+    if opt.summary and set(opt.summary.split(',')) - set(summary.GROUP_KEYS):
+        p.error(f'--summary: choose from {",".join(summary.GROUP_KEYS)}')
+    if opt.prefetch > 0 and opt.workers > 1:
+        p.error('--prefetch is for the serial run. the workers read their own files')
+    if opt.state and (opt.since or opt.until):
+        p.error('--state can not be used with --since/--until. the mails out of the period would be skipped in the next run')
+    if opt.state and opt.full_scan:
+        p.error('--state can not be used with --full-scan. the whole bmf files would be parsed again')
+    return opt
 
 def _parse_date(d: str):
     if d is None:
         return None
     return datetime.datetime.strptime(d, "%Y-%m-%d")
 
+def _csv_line(row:List[Any]):
+    out = io.StringIO()
+    csv.writer(out, lineterminator='', quoting=csv.QUOTE_NONNUMERIC).writerow(row)
+    return out.getvalue()
+
+def _write_csv(out:TextIO, rows:Iterable[List[Any]], flush:bool):
+    "flush: write each row out as soon as it arrives"
+    writer = csv.writer(out, lineterminator='\n', quoting=csv.QUOTE_NONNUMERIC)
+    writer.writerow(r_pay.RakutenPayMail.CSV_VALUE_HEADER)
+    for row in rows:
+        writer.writerow(row)
+        if flush:
+            out.flush()
+
+def _merge_csv(csv_path:str, rows:Iterable[List[Any]]):
+    "merge the sorted rows into the csv file, keeping it sorted by DateTime"
+    def datetime_of(line:str):
+        return next(csv.reader([line]))[0]
+
+    old = open(csv_path, encoding='utf-8') if os.path.exists(csv_path) else io.StringIO()
+    tmp_path = f'{csv_path}.tmp'
+    with old, open(tmp_path, 'w', encoding='utf-8') as h:
+        next(old, None) # header
+        old_lines = ( line.rstrip('\n') for line in old if line.strip() )
+        new_lines = map(_csv_line, rows)
+
+        print(_csv_line(r_pay.RakutenPayMail.CSV_VALUE_HEADER), file=h)
+        for line in heapq.merge(old_lines, new_lines, key=datetime_of):
+            print(line, file=h)
+    os.replace(tmp_path, csv_path)
+
 def main():
     opt = get_cli_option()
     mail_box_path = opt.mail_box_path
     date_since = _parse_date(opt.since)
     date_until = _parse_date(opt.until)
 
+    mail_format = mailsource.detect_format(mail_box_path) if opt.format == 'auto' else opt.format
+    if opt.state is not None and mail_format != mailsource.BECKY:
+        e('--state is only for the becky mailbox. all mails are parsed')
+        opt.state = None
+
     global argv
-    argv = CLIParameter(mail_box_path, date_since, date_until)
+    argv = CLIParameter(mail_box_path, date_since, date_until, opt.full_scan, opt.workers, opt.cache, opt.idx_cache, opt.prefetch, opt.prefetch_size, mail_format, opt.dedupe, opt.failure_samples)
 
-    rakuten_pay_mail_list = sorted(
-        get_rakuten_pay_mails(mail_box_path),
-        key=lambda r: r.datetime
-    )
+    global cache
+    if opt.cache is not None:
+        cache = parse_cache.ParseCache(opt.cache)
 
-    outbuff = io.StringIO()
-    writer  = csv.writer(outbuff, lineterminator='\n', quoting=csv.QUOTE_NONNUMERIC)
-    writer.writerow(r_pay.RakutenPayMail.CSV_VALUE_HEADER)
-    writer.writerows(mail.csv_rawvalues() for mail in rakuten_pay_mail_list)
-    print(outbuff.getvalue())
+    global failures
+    failures = quarantine.FailureSink(opt.failures, opt.failure_samples)
+
+    global watermarks
+    if opt.state is not None:
+        watermarks = _load_watermarks(opt.state)
+
+    stats.ENABLED = opt.stats is not None
+    extra_stats:Dict[str, Any] = {}
+    start = time.perf_counter()
+    with stats.profiling(opt.profile, opt.tracemalloc, extra_stats):
+        if opt.summary:
+            totals = summarize_rakuten_pay_mails(mail_box_path, opt.summary.split(','))
+            if opt.output:
+                with open(opt.output, 'w', encoding='utf-8') as h:
+                    totals.write_csv(h)
+            else:
+                totals.write_csv(sys.stdout)
+        else:
+            rakuten_pay_mails = get_rakuten_pay_mails(mail_box_path)
+            if not opt.no_sort:
+                rakuten_pay_mails = extsort.sorted_external(rakuten_pay_mails, key=lambda r: r.datetime, buffer_size=opt.sort_buffer)
+            columns = None
+            if opt.columnar:
+                columns = columnar.ColumnBuilder()
+                rakuten_pay_mails = columns.collect(rakuten_pay_mails)
+            rows = (mail.csv_rawvalues() for mail in rakuten_pay_mails)
+
+            if opt.merge:
+                _merge_csv(opt.merge, rows)
+            elif opt.output:
+                with open(opt.output, 'w', encoding='utf-8') as h:
+                    _write_csv(h, rows, opt.no_sort)
+            else:
+                _write_csv(sys.stdout, rows, opt.no_sort)
+            if columns is not None:
+                columnar.save(opt.columnar, columns.build())
+    elapsed = time.perf_counter() - start
+
+    if opt.stats:
+        stats.write_report(opt.stats, stats.report(elapsed, workers=opt.workers, **extra_stats))
+
+    if cache is not None:
+        cache.close()
+
+    unparsed = failures.unparsed
+    failed   = failures.close()
+    if failed:
+        e(f'{failed} mails failed to parse. samples are stored in {opt.failures}')
+
+    if dedupe.DEDUPE_STATS:
+        e(f'duplicates skipped: {dedupe.DEDUPE_STATS["msgid"]} by Message-ID / {dedupe.DEDUPE_STATS["receipt"]} by receipt number')
+
+    if folder_idx_errors:
+        e(f'{len(folder_idx_errors)} malformed lines in Folder.idx were skipped')
+
+    # saved only after the result is written
+    if watermarks is not None:
+        _retry_failed_entities(unparsed)
+        watermarks.update(new_watermarks)
+        _save_watermarks(opt.state, watermarks)
 
 if __name__ == '__main__':
     main()
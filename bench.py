@@ -0,0 +1,149 @@
+from typing import *
+import os.path
+import sys
+import time
+import glob
+import json
+import argparse
+import tempfile
+import contextlib
+
+import becky
+import gen_mailbox
+import util
+
+try:
+    import resource
+except ImportError:
+    # not available on windows
+    resource = None
+
+# ============================
+# end to end throughput of becky.get_rakuten_pay_mails
+# ============================
+
+class BenchResult(NamedTuple):
+    mails: int          # mails in Folder.idx
+    bmf_bytes: int
+    parsed: int         # rakuten pay mails
+    seconds: float
+    peak_rss_kib: Optional[int]
+
+    @property
+    def mails_per_sec(self):
+        return self.mails / self.seconds if self.seconds else 0.0
+
+    @property
+    def mib_per_sec(self):
+        return self.bmf_bytes / 1024 / 1024 / self.seconds if self.seconds else 0.0
+
+def _peak_rss_kib():
+    "peak RSS of this process and the worker processes"
+    if resource is None:
+        return None
+    rss = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    # bytes on macOS, KiB on linux
+    return rss // 1024 if sys.platform == 'darwin' else rss
+
+def _count_mails(mail_box_path:str):
+    mails = 0
+    for idx_path in glob.glob('**/Folder.idx', root_dir=mail_box_path, recursive=True):
+        with open(os.path.join(mail_box_path, idx_path), 'rb') as h:
+            mails += max(len(h.read().splitlines()) - 1, 0)
+    bmf_bytes = sum(os.path.getsize(os.path.join(mail_box_path, p)) for p in glob.glob('**/*.bmf', root_dir=mail_box_path, recursive=True))
+    return mails, bmf_bytes
+
+def run(mail_box_path:str, workers:int=1, full_scan:bool=False):
+    "parse the whole mailbox once. the progress on stderr is discarded"
+    becky.argv = becky.CLIParameter(mail_box_path, None, None, full_scan, workers)
+    mails, bmf_bytes = _count_mails(mail_box_path)
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stderr(devnull):
+        start  = time.perf_counter()
+        parsed = sum(1 for _ in becky.get_rakuten_pay_mails(mail_box_path))
+        seconds = time.perf_counter() - start
+    return BenchResult(mails, bmf_bytes, parsed, seconds, _peak_rss_kib())
+
+# ============================
+# ISO-2022-JP decoders
+# ============================
+
+def _iso2022jp_samples():
+    "(name, fragments) of the mail bodies and the header fragments"
+    bodies = []
+    for template in gen_mailbox.TEMPLATES:
+        try:
+            bodies.append(gen_mailbox._load_sample(template).encode('iso-2022-jp'))
+        except UnicodeEncodeError:
+            continue
+    headers = [ subject.encode('iso-2022-jp') for _, _, subjects in gen_mailbox.NOISE_SENDERS for subject in subjects ]
+    headers += [ t.subject.encode('iso-2022-jp') for t in gen_mailbox.TEMPLATES ]
+    return [('body', bodies), ('header', headers)]
+
+def _iso2022jp_decoders():
+    decoders: List[Tuple[str, Callable[[List[bytes]], List[str]]]] = [
+        ('builtin', lambda fragments: [ util.decode(f, 'iso-2022-jp') for f in fragments ]),
+        ('builtin batch', util.decode_iso2022jp_many),
+        ('python iso2022_jp (not cp50220)', lambda fragments: [ f.decode('iso2022_jp') for f in fragments ]),
+    ]
+    try:
+        import nkf
+        decoders.append(('nkf', lambda fragments: [ util._decode_iso2022jp_nkf(f) for f in fragments ]))
+    except ImportError:
+        pass
+    return decoders
+
+def bench_iso2022jp(repeat:int):
+    "yields (decoder, sample, usec per fragment)"
+    for sample, fragments in _iso2022jp_samples():
+        for name, decoder in _iso2022jp_decoders():
+            count = max(1, 20000 // len(fragments))
+            best = float('inf')
+            for _ in range(repeat):
+                start = time.perf_counter()
+                for _ in range(count):
+                    decoder(fragments)
+                best = min(best, time.perf_counter() - start)
+            yield name, sample, best / count / len(fragments) * 1e6
+
+# === main ===
+def get_cli_option():
+    p = argparse.ArgumentParser()
+    p.add_argument('mail_box_path', help='mailbox to parse. generated into a temporary directory when omitted', type=str, nargs='?')
+    p.add_argument('-n', '--mails', help='number of mails to generate', type=int, default=10000)
+    p.add_argument('--folders', help='number of folders to generate', type=int, default=1)
+    p.add_argument('--encodings', help='encodings of the generated mails. see gen_mailbox.py', type=str, default=','.join(gen_mailbox.DEFAULT_ENCODINGS))
+    p.add_argument('-j', '--workers', help='number of worker processes', type=int, default=1)
+    p.add_argument('--full-scan', help='read whole *.bmf files instead of the ranges recorded in Folder.idx', action='store_true')
+    p.add_argument('-r', '--repeat', help='number of runs', type=int, default=3)
+    p.add_argument('--json', help='print the results as json lines', action='store_true')
+    p.add_argument('--iso2022jp', help='compare the ISO-2022-JP decoders (builtin, nkf if installed) instead', action='store_true')
+    return p.parse_args()
+
+def main():
+    opt = get_cli_option()
+    if opt.iso2022jp:
+        for name, sample, usec in bench_iso2022jp(opt.repeat):
+            if opt.json:
+                print(json.dumps({ 'decoder': name, 'sample': sample, 'usec': usec }, ensure_ascii=False))
+            else:
+                print(f'{sample:>6} / {name}: {usec:.2f} usec')
+        return
+
+    with contextlib.ExitStack() as stack:
+        mail_box_path = opt.mail_box_path
+        if mail_box_path is None:
+            mail_box_path = stack.enter_context(tempfile.TemporaryDirectory())
+            generator = gen_mailbox.MailboxGenerator(encodings=opt.encodings.split(','))
+            gen_mailbox.generate(mail_box_path, opt.mails, opt.folders, generator=generator)
+
+        for i in range(opt.repeat):
+            result = run(mail_box_path, opt.workers, opt.full_scan)
+            if opt.json:
+                print(json.dumps({ **result._asdict(), 'mails_per_sec': result.mails_per_sec, 'mib_per_sec': result.mib_per_sec }))
+                continue
+            rss = f'{result.peak_rss_kib / 1024:.1f} MiB' if result.peak_rss_kib is not None else 'n/a'
+            print(f'run {i+1}: {result.mails} mails ({result.parsed} rakuten pay) in {result.seconds:.3f} s'
+                  f' / {result.mails_per_sec:,.0f} mails/s / {result.mib_per_sec:.1f} MiB/s / peak RSS {rss}')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,215 @@
+from typing import *
+import sys
+import os.path
+import csv
+import glob
+import sqlite3
+import argparse
+import datetime
+import email.utils
+
+import becky
+
+join_path = os.path.join
+
+# ============================
+# catalog of all Folder.idx in a mailbox
+# ============================
+
+CATALOG_VERSION = 1
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE IF NOT EXISTS folders (
+    id       INTEGER PRIMARY KEY,
+    path     TEXT UNIQUE,  -- Folder.idx, relative to the mailbox
+    mtime_ns INTEGER,
+    size     INTEGER
+);
+CREATE TABLE IF NOT EXISTS mails (
+    folder_id INTEGER,
+    bmf       TEXT,     -- bmf file, relative to the mailbox
+    body_ptr  INTEGER,
+    size      INTEGER,
+    tsend     INTEGER,  -- time_t
+    sender    TEXT,     -- lower case address part of strFrom
+    msgid     TEXT,
+    subject   TEXT,
+    line      BLOB      -- raw Folder.idx line, to rebuild FolderIdxEntity
+);
+CREATE INDEX IF NOT EXISTS mails_sender ON mails (sender, tsend);
+CREATE INDEX IF NOT EXISTS mails_tsend  ON mails (tsend);
+CREATE INDEX IF NOT EXISTS mails_msgid  ON mails (msgid);
+CREATE INDEX IF NOT EXISTS mails_place  ON mails (folder_id, bmf, body_ptr);
+"""
+
+def _to_str(v: str | bytes):
+    return v if isinstance(v, str) else v.decode('ascii', errors='replace')
+
+def _sender_address(str_from: str | bytes):
+    return email.utils.parseaddr(_to_str(str_from))[1].lower()
+
+def _mail_row(folder_id:int, bmf:str, entity:becky.FolderIdxEntity):
+    return (
+        folder_id,
+        bmf,
+        entity.dwBodyPtr,
+        entity.dwSize,
+        entity.tSend,
+        _sender_address(entity.strFrom),
+        _to_str(entity.strMsgId),
+        _to_str(entity.strSubject),
+        entity.line,
+    )
+
+class Catalog:
+    def __init__(self, path:str, mail_box_path:str):
+        self.mail_box_path = mail_box_path
+        self.conn = sqlite3.connect(path)
+        self.conn.executescript(SCHEMA)
+
+        version = str(CATALOG_VERSION)
+        row = self.conn.execute("SELECT value FROM meta WHERE key = 'version'").fetchone()
+        if row is None or row[0] != version:
+            self.conn.execute('DELETE FROM mails')
+            self.conn.execute('DELETE FROM folders')
+            self.conn.execute("INSERT OR REPLACE INTO meta VALUES ('version', ?)", (version,))
+        self.conn.commit()
+
+    def build(self):
+        """
+        (re)index the Folder.idx files. the folders whose Folder.idx is unchanged are skipped.
+        returns (updated folder count, removed folder count)
+        """
+        idx_list = glob.glob('**/Folder.idx', root_dir=self.mail_box_path, recursive=True)
+        idx_list = [ p.replace(os.sep, '/') for p in idx_list ]
+        known    = { path: (folder_id, mtime_ns, size) for folder_id, path, mtime_ns, size in self.conn.execute('SELECT id, path, mtime_ns, size FROM folders') }
+
+        updated = 0
+        for idx_path in idx_list:
+            idx_stat = os.stat(join_path(self.mail_box_path, idx_path))
+            folder   = known.get(idx_path)
+            if folder is not None and folder[1:] == (idx_stat.st_mtime_ns, idx_stat.st_size):
+                continue
+            self._index_folder(idx_path, idx_stat, folder[0] if folder else None)
+            updated += 1
+
+        removed = set(known) - set(idx_list)
+        for idx_path in removed:
+            folder_id = known[idx_path][0]
+            self.conn.execute('DELETE FROM mails WHERE folder_id = ?', (folder_id,))
+            self.conn.execute('DELETE FROM folders WHERE id = ?', (folder_id,))
+        self.conn.commit()
+        return updated, len(removed)
+
+    def _index_folder(self, idx_path:str, idx_stat:os.stat_result, folder_id:Optional[int]):
+        if folder_id is None:
+            folder_id = self.conn.execute('INSERT INTO folders (path) VALUES (?)', (idx_path,)).lastrowid
+        else:
+            self.conn.execute('DELETE FROM mails WHERE folder_id = ?', (folder_id,))
+        self.conn.execute('UPDATE folders SET mtime_ns = ?, size = ? WHERE id = ?', (idx_stat.st_mtime_ns, idx_stat.st_size, folder_id))
+
+        dir_name = os.path.dirname(idx_path)
+        entities = becky._load_folder_idx(join_path(self.mail_box_path, idx_path))
+        rows = (
+            _mail_row(folder_id, f'{dir_name}/{entity.dwFileName:>08}.bmf' if dir_name else f'{entity.dwFileName:>08}.bmf', entity)
+            for entity in entities
+        )
+        self.conn.executemany('INSERT INTO mails VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', rows)
+
+    def query(self,
+              sender:Optional[str]=None,
+              since:Optional[datetime.datetime]=None,
+              until:Optional[datetime.datetime]=None,
+              msgid:Optional[str]=None,
+              subject:Optional[str]=None):
+        """
+        sender: mail address. '*' is a wildcard (ex: *@pay.rakuten.co.jp)
+        until : inclusive, same as becky.py
+        subject: substring
+        yields (bmf, body_ptr, size, tsend, sender, msgid, subject, line) ordered by tsend
+        """
+        where:List[str] = []
+        params:List[Any] = []
+        if sender is not None:
+            sender = sender.lower()
+            if '*' in sender:
+                where.append("sender LIKE ? ESCAPE '\\'")
+                params.append(sender.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_').replace('*', '%'))
+            else:
+                where.append('sender = ?')
+                params.append(sender)
+        if since is not None:
+            where.append('tsend >= ?')
+            params.append(int(since.timestamp()))
+        if until is not None:
+            where.append('tsend <= ?')
+            params.append(int((until + datetime.timedelta(days=1)).timestamp()))
+        if msgid is not None:
+            where.append('msgid = ?')
+            params.append(msgid)
+        if subject is not None:
+            where.append('instr(subject, ?) > 0')
+            params.append(subject)
+
+        sql = 'SELECT bmf, body_ptr, size, tsend, sender, msgid, subject, line FROM mails'
+        if where:
+            sql += ' WHERE ' + ' AND '.join(where)
+        sql += ' ORDER BY tsend, folder_id, bmf, body_ptr'
+        yield from self.conn.execute(sql, params)
+
+    def close(self):
+        self.conn.close()
+
+def parse_matches(mail_box_path:str, matches:Iterable[Tuple]):
+    "parse the matched mails with the rakuten pay parser. yields RakutenPayMail"
+    bmf_entities: Dict[str, List[becky.FolderIdxEntity]] = {}
+    for bmf, *_, line in matches:
+        bmf_entities.setdefault(bmf, []).append(becky.FolderIdxEntity(line))
+    for bmf in sorted(bmf_entities):
+        yield from becky.parse_indexed_mail(join_path(mail_box_path, bmf), bmf_entities[bmf])
+
+# === main ===
+def get_cli_option():
+    p = argparse.ArgumentParser()
+    p.add_argument('mail_box_path', help='specify the directory to *.bmf files.', type=str)
+    p.add_argument('--catalog', help='sqlite file of the catalog', type=str, default='catalog.sqlite')
+    sub = p.add_subparsers(dest='command', required=True)
+
+    sub.add_parser('build', help='index all Folder.idx in the mailbox')
+
+    q = sub.add_parser('query', help='list the mails in the catalog')
+    q.add_argument('--from', dest='sender', help='ex) no-reply@pay.rakuten.co.jp, *@rakuten.co.jp', type=str)
+    q.add_argument('-s', '--since', help='ex) 2025-01-01', type=str)
+    q.add_argument('-u', '--until', help='ex) 2025-01-01', type=str)
+    q.add_argument('--msgid', help='Message-ID', type=str)
+    q.add_argument('--subject', help='substring of the subject', type=str)
+    q.add_argument('--parse', help='parse the matched mails and print them as csv', action='store_true')
+    q.add_argument('--no-build', help='query without updating the catalog', action='store_true')
+    return p.parse_args()
+
+def main():
+    opt = get_cli_option()
+    catalog = Catalog(opt.catalog, opt.mail_box_path)
+    try:
+        if opt.command == 'build' or not opt.no_build:
+            updated, removed = catalog.build()
+            becky.w(f'catalog: {updated} folders updated / {removed} folders removed')
+        if opt.command == 'build':
+            return
+
+        matches = catalog.query(opt.sender, becky._parse_date(opt.since), becky._parse_date(opt.until), opt.msgid, opt.subject)
+        if opt.parse:
+            pay_mails = sorted(parse_matches(opt.mail_box_path, matches), key=lambda r: r.datetime)
+            becky._write_csv(sys.stdout, (mail.csv_rawvalues() for mail in pay_mails), False)
+            return
+
+        writer = csv.writer(sys.stdout, lineterminator='\n', quoting=csv.QUOTE_NONNUMERIC)
+        writer.writerow(['DateTime', 'From', 'Subject', 'Message-ID', 'bmf', 'Offset', 'Size'])
+        for bmf, body_ptr, size, tsend, sender, msgid, subject, _ in matches:
+            writer.writerow([datetime.datetime.fromtimestamp(tsend).isoformat(' '), sender, subject, msgid, bmf, body_ptr, size])
+    finally:
+        catalog.close()
+
+if __name__ == '__main__':
+    main()
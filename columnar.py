@@ -0,0 +1,223 @@
+from typing import *
+import os.path
+import re
+import csv
+import datetime
+import calendar
+
+import rakuten_pay_mail_parser as r_pay
+
+# ============================
+# columnar export of RakutenPayMail
+#  .npz: numpy (required)
+#  .parquet / .arrow / .feather: pyarrow (optional)
+# ============================
+
+INT_NULL = -(1 << 63)
+"None (or an unparsable value) in the int64 columns"
+
+STR_COLUMNS = ('receipt_no', 'store_tel', 'message_id')
+INT_COLUMNS = ('datetime', 'use_point', 'use_cash', 'total')
+
+class PaymentColumns(NamedTuple):
+    datetime:    Any    # int64, epoch seconds of the wall clock (JST) as if it was UTC
+    receipt_no:  Any    # str
+    store_code:  Any    # int32, index of store_names. -1: None
+    store_names: Any    # str, the dictionary of store_code
+    store_tel:   Any    # str
+    use_point:   Any    # int64
+    use_cash:    Any    # int64
+    total:       Any    # int64
+    message_id:  Any    # str
+    has_error:   Any    # bool
+
+    @property
+    def rows(self):
+        return len(self.datetime)
+
+    @property
+    def store_name(self):
+        "decoded store names. '' for None"
+        import numpy as np
+        return np.append(self.store_names, '')[self.store_code]
+
+def _epoch(d:Optional[datetime.datetime]):
+    if not isinstance(d, datetime.datetime):
+        return INT_NULL
+    # the naive datetime is kept as the wall clock. datetime64 gives the same calendar
+    return calendar.timegm(d.timetuple())
+
+RE_NOT_DIGIT = re.compile(r'[^0-9\-]')
+def _int(v:Any):
+    "int, or '1,000円' / '0ポイント' as the templates leave them"
+    if isinstance(v, int):
+        return v
+    if isinstance(v, float):
+        return int(v)
+    if not v:
+        return INT_NULL
+    try:
+        return int(RE_NOT_DIGIT.sub('', str(v)))
+    except ValueError:
+        return INT_NULL
+
+def _str(v:Any):
+    return '' if v is None else str(v)
+
+class ColumnBuilder:
+    "append RakutenPayMail one by one, then build() the columns at once"
+    def __init__(self):
+        self.values: Dict[str, List[Any]] = { name: [] for name in STR_COLUMNS + INT_COLUMNS + ('store_code', 'has_error') }
+        self.store_codes: Dict[str, int] = {}
+
+    def append(self, mail:r_pay.RakutenPayMail):
+        v = self.values
+        v['datetime'].append(_epoch(mail.datetime))
+        v['receipt_no'].append(_str(mail.receipt_no))
+        v['store_tel'].append(_str(mail.store_tel))
+        v['use_point'].append(_int(mail.use_point))
+        v['use_cash'].append(_int(mail.use_cash))
+        v['total'].append(_int(mail.total))
+        v['message_id'].append(_str(mail.message_id))
+        v['has_error'].append(bool(mail.has_error))
+        store = mail.store_name
+        v['store_code'].append(-1 if store is None else self.store_codes.setdefault(store, len(self.store_codes)))
+
+    def collect(self, mails:Iterable[r_pay.RakutenPayMail]):
+        "append the mails while passing them through"
+        for mail in mails:
+            self.append(mail)
+            yield mail
+
+    def build(self):
+        import numpy as np
+        v = self.values
+        def strings(values:List[str]):
+            return np.array(values, dtype=str) if values else np.zeros(0, dtype='U1')
+        return PaymentColumns(
+            datetime    = np.array(v['datetime'], dtype=np.int64),
+            receipt_no  = strings(v['receipt_no']),
+            store_code  = np.array(v['store_code'], dtype=np.int32),
+            store_names = strings(list(self.store_codes)),
+            store_tel   = strings(v['store_tel']),
+            use_point   = np.array(v['use_point'], dtype=np.int64),
+            use_cash    = np.array(v['use_cash'], dtype=np.int64),
+            total       = np.array(v['total'], dtype=np.int64),
+            message_id  = strings(v['message_id']),
+            has_error   = np.array(v['has_error'], dtype=bool),
+        )
+
+def from_mails(mails:Iterable[r_pay.RakutenPayMail]):
+    builder = ColumnBuilder()
+    for mail in mails:
+        builder.append(mail)
+    return builder.build()
+
+class _CsvRow(NamedTuple):
+    "RakutenPayMail look-alike of a csv row written by becky.py"
+    datetime: Optional[datetime.datetime]
+    receipt_no: str
+    store_name: str
+    store_tel: str
+    use_point: Any
+    use_cash: Any
+    total: Any
+    message_id: str
+    has_error: bool = False
+
+def from_csv(path:str):
+    "columns of the csv written by becky.py"
+    def parse_datetime(s:str):
+        try:
+            return datetime.datetime.fromisoformat(s)
+        except ValueError:
+            return None
+
+    builder = ColumnBuilder()
+    with open(path, encoding='utf-8', newline='') as h:
+        reader = csv.reader(h)
+        next(reader, None) # header
+        for row in reader:
+            if len(row) < 8:
+                continue
+            date, receipt_no, store, tel, point, cash, total, msgid = row[:8]
+            builder.append(_CsvRow(parse_datetime(date), receipt_no, store, tel, point, cash, total, msgid))
+    return builder.build()
+
+# === files ===
+ARROW_EXTENSIONS = ('.parquet', '.arrow', '.feather')
+
+def _to_arrow(cols:PaymentColumns):
+    import numpy as np
+    import pyarrow as pa
+    def ints(values, type=pa.int64()):
+        return pa.array(values, type=type, mask=values == INT_NULL)
+    store_code = pa.array(cols.store_code, mask=cols.store_code < 0)
+    return pa.table({
+        'datetime':   ints(cols.datetime, pa.timestamp('s')),
+        'receipt_no': pa.array(cols.receipt_no, pa.string()),
+        'store_name': pa.DictionaryArray.from_arrays(store_code, pa.array(cols.store_names, pa.string())),
+        'store_tel':  pa.array(cols.store_tel, pa.string()),
+        'use_point':  ints(cols.use_point),
+        'use_cash':   ints(cols.use_cash),
+        'total':      ints(cols.total),
+        'message_id': pa.array(cols.message_id, pa.string()),
+        'has_error':  pa.array(cols.has_error, pa.bool_()),
+    })
+
+def _from_arrow(table):
+    import numpy as np
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    def ints(name:str):
+        column = table.column(name).cast(pa.int64())
+        return pc.fill_null(column, INT_NULL).to_numpy()
+    def strings(name:str):
+        return np.array(table.column(name).to_pylist(), dtype=str) if table.num_rows else np.zeros(0, dtype='U1')
+
+    store = table.column('store_name').combine_chunks()
+    if not pa.types.is_dictionary(store.type):
+        store = pc.dictionary_encode(store)
+    return PaymentColumns(
+        datetime    = ints('datetime'),
+        receipt_no  = strings('receipt_no'),
+        store_code  = pc.fill_null(store.indices, -1).to_numpy().astype(np.int32),
+        store_names = np.array(store.dictionary.to_pylist(), dtype=str) if len(store.dictionary) else np.zeros(0, dtype='U1'),
+        store_tel   = strings('store_tel'),
+        use_point   = ints('use_point'),
+        use_cash    = ints('use_cash'),
+        total       = ints('total'),
+        message_id  = strings('message_id'),
+        has_error   = table.column('has_error').to_numpy(),
+    )
+
+def save(path:str, cols:PaymentColumns):
+    "the format is chosen by the extension. .npz, or .parquet/.arrow/.feather with pyarrow"
+    ext = os.path.splitext(path)[1].lower()
+    if ext == '.parquet':
+        import pyarrow.parquet as pq
+        pq.write_table(_to_arrow(cols), path)
+    elif ext in ARROW_EXTENSIONS:
+        import pyarrow.feather as feather
+        feather.write_feather(_to_arrow(cols), path)
+    else:
+        import numpy as np
+        # np.savez appends .npz to the other names
+        with open(path, 'wb') as h:
+            np.savez(h, **cols._asdict())
+
+def load(path:str):
+    "the files written by save(), or the csv written by becky.py"
+    ext = os.path.splitext(path)[1].lower()
+    if ext == '.csv':
+        return from_csv(path)
+    if ext == '.parquet':
+        import pyarrow.parquet as pq
+        return _from_arrow(pq.read_table(path))
+    if ext in ARROW_EXTENSIONS:
+        import pyarrow.feather as feather
+        return _from_arrow(feather.read_table(path))
+
+    import numpy as np
+    with np.load(path, allow_pickle=False) as npz:
+        return PaymentColumns(**{ name: npz[name] for name in PaymentColumns._fields })
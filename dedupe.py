@@ -0,0 +1,117 @@
+from typing import *
+import array
+import hashlib
+
+import rakuten_pay_mail_parser as r_pay
+import stats
+
+# ============================
+# duplicate suppression (the same mail in several folders)
+# ============================
+
+OFF     = 'off'
+MSGID   = 'msgid'
+RECEIPT = 'receipt'
+LEVELS  = (OFF, MSGID, RECEIPT)
+"""
+msgid  : the same Message-ID is parsed once. checked with Folder.idx before reading the bmf files
+receipt: and the same receipt number of the same template is written once
+"""
+
+DEDUPE_STATS = stats.counter('dedupe')
+"skipped duplicates. msgid, receipt"
+
+def fingerprint(key:str | bytes):
+    "64-bit blake2b of the key. never 0 (the empty slot of FingerprintSet)"
+    if isinstance(key, str):
+        key = key.encode('utf-8', 'surrogateescape')
+    return int.from_bytes(hashlib.blake2b(key, digest_size=8).digest(), 'little') or 1
+
+class FingerprintSet:
+    """
+    set of 64-bit fingerprints, open addressing over array('Q').
+    16 bytes per key at most (half full), while a set of int takes about 4 times of it.
+    the false positive rate is about n^2 / 2^65: 3e-8 for a million keys.
+    """
+    def __init__(self, capacity:int=1024):
+        size = 1
+        while size < capacity * 2:
+            size <<= 1
+        self.slots = array.array('Q', bytes(8 * size))
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def _find(self, fp:int):
+        slots = self.slots
+        mask  = len(slots) - 1
+        # the fingerprint is already a hash
+        i = fp & mask
+        while True:
+            v = slots[i]
+            if v == 0 or v == fp:
+                return i
+            i = (i + 1) & mask
+
+    def __contains__(self, key:str | bytes):
+        fp = fingerprint(key)
+        return self.slots[self._find(fp)] == fp
+
+    def add(self, key:str | bytes):
+        "returns False when the key is already in the set"
+        fp = fingerprint(key)
+        i  = self._find(fp)
+        if self.slots[i] == fp:
+            return False
+        self.slots[i] = fp
+        self.count += 1
+        if self.count * 2 > len(self.slots):
+            self._grow()
+        return True
+
+    def _grow(self):
+        old = self.slots
+        self.slots = array.array('Q', bytes(16 * len(old)))
+        for fp in old:
+            if fp:
+                self.slots[self._find(fp)] = fp
+
+class Deduper:
+    def __init__(self, level:str=MSGID):
+        if level not in LEVELS:
+            raise ValueError(f'unknown dedupe level: {level}')
+        self.level = level
+        self.msgids   = FingerprintSet()
+        self.receipts = FingerprintSet()
+
+    def is_duplicate_msgid(self, msgid:Optional[str | bytes]):
+        "the first one is not a duplicate. a mail without Message-ID is never a duplicate"
+        if self.level == OFF or not msgid:
+            return False
+        msgid = msgid.strip()
+        if not msgid or self.msgids.add(msgid):
+            return False
+        DEDUPE_STATS['msgid'] += 1
+        return True
+
+    def is_duplicate_receipt(self, pay_mail:r_pay.RakutenPayMail):
+        # an order confirmation and its payment have the same number. the template is a part of the key
+        if self.level != RECEIPT or not pay_mail.receipt_no:
+            return False
+        if self.receipts.add(f'{type(pay_mail).__name__}:{pay_mail.receipt_no}'):
+            return False
+        DEDUPE_STATS['receipt'] += 1
+        return True
+
+    def filter(self, pay_mails:Iterable[r_pay.RakutenPayMail], by_msgid:bool=True):
+        """
+        drop the duplicates of the parsed mails.
+        by_msgid: False when the Message-IDs are already checked with Folder.idx
+        """
+        for pay_mail in pay_mails:
+            if by_msgid and self.is_duplicate_msgid(pay_mail.message_id):
+                continue
+            if self.is_duplicate_receipt(pay_mail):
+                continue
+            yield pay_mail
@@ -1,23 +1,36 @@
 from typing import *
+import time
 import argparse
-import email
 
 import rakuten_pay_mail_parser
+import quarantine
+import stats
 
 def _main():
     p = argparse.ArgumentParser()
     p.add_argument("email_path")
+    p.add_argument('--stats', help='write the per-stage timings and the counters to this json file', type=str)
     opt = p.parse_args()
 
+    stats.ENABLED = opt.stats is not None
+    start = time.perf_counter()
+
     email_path = opt.email_path
-    with open(email_path, "rb") as h:
-        mail = email.message_from_binary_file(h)
+    with stats.stage('read'):
+        with open(email_path, "rb") as h:
+            mail_raw = h.read()
+    main_stats = stats.counter('main')
+    main_stats['mails'] += 1
+    main_stats['bytes_read'] += len(mail_raw)
     try:
-        pay_mail = rakuten_pay_mail_parser.parse_email(mail)
+        pay_mail = rakuten_pay_mail_parser.parse_bytes(mail_raw)
         print(pay_mail)
     except rakuten_pay_mail_parser.UnexcpectedRakutenPayMailException as ex:
-        for stack in ex.stack_trace_list or []:
-            print(stack)
+        main_stats['failed'] += 1
+        print(quarantine.format_failure(ex))
+
+    if opt.stats:
+        stats.write_report(opt.stats, stats.report(time.perf_counter() - start))
 
 if __name__ == '__main__':
     _main()
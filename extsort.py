@@ -0,0 +1,45 @@
+from typing import *
+import heapq
+import pickle
+import tempfile
+
+# ============================
+# external merge sort
+# ============================
+
+T = TypeVar('T')
+
+def _write_run(items:List[Any]):
+    run = tempfile.TemporaryFile()
+    for item in items:
+        pickle.dump(item, run, protocol=pickle.HIGHEST_PROTOCOL)
+    run.seek(0)
+    return run
+
+def _read_run(run:IO[bytes]):
+    with run:
+        while True:
+            try:
+                yield pickle.load(run)
+            except EOFError:
+                return
+
+def sorted_external(iterable:Iterable[T], key:Callable[[T], Any], buffer_size:int=100000) -> Iterator[T]:
+    """
+    same result as sorted(iterable, key=key) (stable), but keeps at most buffer_size items in memory.
+    when the buffer is full, it is sorted and spilled to a temporary file, and the runs are merged at the end.
+    """
+    runs:List[IO[bytes]] = []
+    buffer:List[T] = []
+    for item in iterable:
+        buffer.append(item)
+        if len(buffer) >= buffer_size:
+            buffer.sort(key=key)
+            runs.append(_write_run(buffer))
+            buffer = []
+    buffer.sort(key=key)
+
+    if not runs:
+        return iter(buffer)
+    # heapq.merge takes the earlier run first on ties, so the sort stays stable.
+    return heapq.merge(*map(_read_run, runs), buffer, key=key)
@@ -0,0 +1,247 @@
+from typing import *
+import os.path
+import re
+import sys
+import base64
+import random
+import argparse
+import datetime
+import quopri
+import email.header
+
+join_path = os.path.join
+
+# ============================
+# synthetic Becky mailbox for benchmarks
+# ============================
+
+SAMPLE_DIR = join_path(os.path.dirname(os.path.abspath(__file__)), 'sample')
+
+class Template(NamedTuple):
+    name: str
+    sample: str        # file in sample/
+    content_type: str
+    charset: str       # charset of the sample file
+    from_: str
+    subject: str
+    receipt_no: str    # receipt no in the sample. replaced for each mail
+    re_datetime: str   # datetime in the sample. replaced for each mail
+    datetime_format: str
+
+WEEKDAYS = '月火水木金土日'
+TEXT_DATETIME = (r'\d{4}/\d{2}/\d{2}\(.\) \d{2}:\d{2}', '%Y/%m/%d({weekday}) %H:%M')
+HTML_DATETIME = (r'\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2}', '%Y-%m-%d %H:%M:%S')
+
+TEMPLATES = [
+    Template('text_current',  'text_current.txt',  'text/plain', 'utf-8',     'no-reply@pay.rakuten.co.jp',   '楽天ペイアプリご利用内容確認メール', 'AAAAA00000-000000000000-111-2222', *TEXT_DATETIME),
+    Template('text_legacy',   'text_legacy.txt',   'text/plain', 'utf-8',     'no-reply@pay.rakuten.co.jp',   '楽天ペイアプリご利用内容確認メール', 'KKKK000000-111111111111-222-3333', *TEXT_DATETIME),
+    Template('text00',        'text00.txt',        'text/plain', 'utf-8',     'no-reply@pay.rakuten.co.jp',   '楽天ペイ 請求書払い ご利用内容確認', 'InvoicePay-230404123456-444-4444',  *TEXT_DATETIME),
+    Template('html00',        'html00.html',       'text/html',  'shift_jis', 'no-reply@pay.rakuten.co.jp',   '楽天ペイ ご利用内容確認',           '20181219000000012345',              *HTML_DATETIME),
+    Template('html2018',      'html2018.html',     'text/html',  'shift_jis', 'no-reply@pay.rakuten.co.jp',   '楽天ペイ ご利用内容確認',           '20181219000000012345',              *HTML_DATETIME),
+    Template('html_current',  'html_current.html', 'text/html',  'utf-8',     'no-reply@pay.rakuten.co.jp',   '楽天ペイ ご利用内容確認',           '1000000420-20190420-0420042004',    *HTML_DATETIME),
+    Template('order_confirm', 'html01.html',       'text/html',  'utf-8',     'order@checkout.rakuten.co.jp', '楽天ペイ お申込完了',               'sub_0A1K2A3R4I5',                   *HTML_DATETIME),
+]
+
+# mails which are not parsed. (name, address, subjects)
+# the one from the rakuten pay address has a subject in IGNORE_MAIL_SUBJECTS, so it passes the From test only.
+NOISE_SENDERS = [
+    ('お知らせ',   'info@shop.example.jp',       ['週末セールのお知らせ', 'キャンペーンエントリー完了']),
+    ('Newsletter', 'news@example.com',           ['Weekly digest']),
+    ('友人',       'friend@example.net',         ['今度の飲み会について', 'Re: 写真送ります']),
+    ('楽天ペイ',   'no-reply@pay.rakuten.co.jp', ['お支払元登録完了のお知らせ']),
+    ('楽天市場',   'info@rakuten.co.jp',         ['ご注文内容確認', 'ポイント獲得のお知らせ']),
+]
+NOISE_SENTENCES = [
+    'いつもご利用いただきありがとうございます。',
+    '本メールは送信専用のアドレスから送信しています。',
+    'ポイントが当たるキャンペーンを開催中です。',
+    'Thank you for subscribing to our newsletter.',
+    '詳しくは下記のページをご覧ください。',
+    '今週末の予定はいかがでしょうか。',
+]
+
+TRANSFER_ENCODINGS = ['base64', 'quoted-printable', 'iso-2022-jp', '8bit']
+"iso-2022-jp: the body is converted to iso-2022-jp and sent as 7bit"
+DEFAULT_ENCODINGS = TRANSFER_ENCODINGS
+
+def _load_sample(template:Template):
+    with open(join_path(SAMPLE_DIR, template.sample), 'rb') as h:
+        return h.read().decode('cp932' if template.charset == 'shift_jis' else template.charset)
+
+def _encode_header(value:str, charset:str):
+    return email.header.Header(value, charset).encode()
+
+def _encode_body(text:str, charset:str, transfer_encoding:str):
+    "returns (charset, Content-Transfer-Encoding, body bytes)"
+    if transfer_encoding == 'iso-2022-jp':
+        try:
+            return 'iso-2022-jp', '7bit', text.encode('iso-2022-jp')
+        except UnicodeEncodeError:
+            # not in JIS X 0208 (ex: NEC special characters)
+            transfer_encoding = 'base64'
+    raw = text.encode('cp932' if charset == 'shift_jis' else charset)
+    if transfer_encoding == 'base64':
+        return charset, 'base64', base64.encodebytes(raw).replace(b'\n', b'\r\n')
+    if transfer_encoding == 'quoted-printable':
+        return charset, 'quoted-printable', quopri.encodestring(raw).replace(b'\r\n', b'\n').replace(b'\n', b'\r\n')
+    return charset, '8bit', raw
+
+def _part(content_type:str, charset:str, transfer_encoding:str, body:bytes):
+    return (
+        f'Content-Type: {content_type}; charset={charset}\r\n'
+        f'Content-Transfer-Encoding: {transfer_encoding}\r\n'
+        '\r\n'
+    ).encode('ascii') + body
+
+class GeneratedMail(NamedTuple):
+    raw: bytes
+    from_: str
+    subject: str
+    msgid: str
+    tsend: int
+
+def _make_mail(name:str, address:str, subject:str, msgid:str, tsend:datetime.datetime, parts:List[bytes], header_charset:str):
+    boundary = f'----=_Part_{msgid.strip("<>").split("@")[0]}'
+    header = (
+        f'From: {_encode_header(name, header_charset)} <{address}>\r\n'
+        f'To: me@example.jp\r\n'
+        f'Subject: {_encode_header(subject, header_charset)}\r\n'
+        f'Message-ID: {msgid}\r\n'
+        f'Date: {tsend.strftime("%a, %d %b %Y %H:%M:%S +0900")}\r\n'
+        'MIME-Version: 1.0\r\n'
+        f'Content-Type: multipart/alternative; boundary="{boundary}"\r\n'
+        '\r\n'
+    ).encode('ascii')
+    body = b''.join(f'--{boundary}\r\n'.encode('ascii') + part + b'\r\n' for part in parts)
+    raw  = header + body + f'--{boundary}--\r\n'.encode('ascii')
+    return GeneratedMail(raw, f'{name} <{address}>', subject, msgid, int(tsend.timestamp()))
+
+class MailboxGenerator:
+    def __init__(self, seed:int=1, rakuten_ratio:float=0.2, broken_ratio:float=0.0, attachment_ratio:float=0.05, encodings:List[str]=DEFAULT_ENCODINGS):
+        self.random           = random.Random(seed)
+        self.rakuten_ratio    = rakuten_ratio
+        self.broken_ratio     = broken_ratio
+        self.attachment_ratio = attachment_ratio
+        self.encodings        = encodings
+        self.samples          = { t.name: _load_sample(t) for t in TEMPLATES }
+        self.count            = 0
+
+    def _rakuten_mail(self, template:Template, msgid:str, tsend:datetime.datetime):
+        text = self.samples[template.name]
+        receipt_no = template.receipt_no[:-8] + f'{self.count:08d}'
+        text = text.replace(template.receipt_no, receipt_no)
+        used = tsend.strftime(template.datetime_format.format(weekday=WEEKDAYS[tsend.weekday()]))
+        text = re.sub(template.re_datetime, used, text, count=1)
+        if self.random.random() < self.broken_ratio:
+            text = text[:len(text) // 3]
+
+        transfer_encoding = self.random.choice(self.encodings)
+        parts = [_part(template.content_type, *_encode_body(text, template.charset, transfer_encoding))]
+        if template.content_type == 'text/html':
+            plain = 'このメールはHTML形式です。\r\n'
+            parts.insert(0, _part('text/plain', *_encode_body(plain, 'utf-8', transfer_encoding)))
+        header_charset = 'iso-2022-jp' if transfer_encoding == 'iso-2022-jp' else 'utf-8'
+        return _make_mail('楽天ペイ', template.from_, template.subject, msgid, tsend, parts, header_charset)
+
+    def _noise_mail(self, msgid:str, tsend:datetime.datetime):
+        name, address, subjects = self.random.choice(NOISE_SENDERS)
+        subject = self.random.choice(subjects)
+        lines   = self.random.choices(NOISE_SENTENCES, k=self.random.randint(5, 200))
+        text    = '\r\n'.join(lines) + '\r\n'
+        transfer_encoding = self.random.choice(self.encodings)
+        parts = [_part('text/plain', *_encode_body(text, 'utf-8', transfer_encoding))]
+        if self.random.random() < self.attachment_ratio:
+            data = self.random.randbytes(self.random.randint(10 * 1024, 200 * 1024))
+            parts.append(
+                b'Content-Type: application/octet-stream; name="attachment.bin"\r\n'
+                b'Content-Transfer-Encoding: base64\r\n'
+                b'Content-Disposition: attachment; filename="attachment.bin"\r\n'
+                b'\r\n' + base64.encodebytes(data).replace(b'\n', b'\r\n'))
+        header_charset = 'iso-2022-jp' if transfer_encoding == 'iso-2022-jp' else 'utf-8'
+        return _make_mail(name, address, subject, msgid, tsend, parts, header_charset)
+
+    def mail(self, tsend:datetime.datetime):
+        self.count += 1
+        msgid = f'<gen{self.count:08d}@example.jp>'
+        if self.random.random() < self.rakuten_ratio:
+            return self._rakuten_mail(self.random.choice(TEMPLATES), msgid, tsend)
+        return self._noise_mail(msgid, tsend)
+
+def _idx_line(body_ptr:int, msg_no:int, bmf_name:str, mail:GeneratedMail):
+    cells = [
+        f'{body_ptr:x}'.encode('ascii'),  # dwBodyPtr
+        f'{msg_no:x}'.encode('ascii'),    # dwMsgID
+        bmf_name.encode('ascii'),         # dwFileName
+        mail.subject.encode('cp932'),     # strSubject
+        mail.from_.encode('cp932'),       # strFrom
+        b'me@example.jp',                 # strTo
+        mail.msgid.encode('ascii'),       # strMsgId
+        b'',                              # strReferences
+        f'{mail.tsend:x}'.encode('ascii'),      # tSend
+        f'{mail.tsend:x}'.encode('ascii'),      # tRecv
+        f'{mail.tsend + 60:x}'.encode('ascii'), # tDnld
+        f'{len(mail.raw):x}'.encode('ascii'),   # dwSize
+        b'0', b'0', b'3', b'0',           # dwStatus, nColor, nPriority, dwParentID
+        b'iso-2022-jp',                   # strCharSet
+        b'', b'',                         # str, strExtAtch
+    ]
+    return b'\x01'.join(cells)
+
+def generate(mail_box_path:str, mail_count:int, folder_count:int=1, mails_per_bmf:int=1000,
+             since:datetime.datetime=datetime.datetime(2019, 1, 1), generator:Optional[MailboxGenerator]=None):
+    """
+    writes mail_count mails into folder_count folders under mail_box_path.
+    returns the total size of the bmf files.
+    """
+    generator = generator or MailboxGenerator()
+    interval  = datetime.timedelta(hours=7, minutes=13)
+    total     = 0
+    for folder_no in range(folder_count):
+        folder_path = join_path(mail_box_path, 'gen.mb', f'folder{folder_no:02}')
+        os.makedirs(folder_path, exist_ok=True)
+        idx_lines = [b'Becky! Folder.idx (generated)']
+        count = mail_count // folder_count + (1 if folder_no < mail_count % folder_count else 0)
+        bmf = None
+        for i in range(count):
+            if i % mails_per_bmf == 0:
+                if bmf is not None:
+                    bmf.close()
+                bmf_name = f'{i // mails_per_bmf + 1:x}'
+                bmf = open(join_path(folder_path, f'{bmf_name:>08}.bmf'), 'wb')
+            mail = generator.mail(since + interval * (i * folder_count + folder_no))
+            idx_lines.append(_idx_line(bmf.tell(), i + 1, bmf_name, mail))
+            bmf.write(mail.raw)
+            bmf.write(b'\r\n.\r\n')
+            total += len(mail.raw)
+        if bmf is not None:
+            bmf.close()
+        with open(join_path(folder_path, 'Folder.idx'), 'wb') as h:
+            h.write(b'\r\n'.join(idx_lines) + b'\r\n')
+    return total
+
+# === main ===
+def get_cli_option():
+    p = argparse.ArgumentParser()
+    p.add_argument('mail_box_path', help='directory to write the mailbox', type=str)
+    p.add_argument('-n', '--mails', help='number of mails', type=int, default=10000)
+    p.add_argument('--folders', help='number of folders', type=int, default=1)
+    p.add_argument('--mails-per-bmf', help='number of mails in a bmf file', type=int, default=1000)
+    p.add_argument('--rakuten-ratio', help='ratio of rakuten pay mails', type=float, default=0.2)
+    p.add_argument('--broken-ratio', help='ratio of truncated rakuten pay mails', type=float, default=0.0)
+    p.add_argument('--attachment-ratio', help='ratio of noise mails with an attachment', type=float, default=0.05)
+    p.add_argument('--encodings', help=f'comma separated list of {",".join(TRANSFER_ENCODINGS)}', type=str, default=','.join(DEFAULT_ENCODINGS))
+    p.add_argument('--seed', help='random seed', type=int, default=1)
+    opt = p.parse_args()
+    unknown = set(opt.encodings.split(',')) - set(TRANSFER_ENCODINGS)
+    if unknown:
+        p.error(f'unknown encodings: {",".join(sorted(unknown))}')
+    return opt
+
+def main():
+    opt = get_cli_option()
+    generator = MailboxGenerator(opt.seed, opt.rakuten_ratio, opt.broken_ratio, opt.attachment_ratio, opt.encodings.split(','))
+    total = generate(opt.mail_box_path, opt.mails, opt.folders, opt.mails_per_bmf, generator=generator)
+    print(f'{opt.mails} mails / {total / 1024 / 1024:.1f} MiB', file=sys.stderr)
+
+if __name__ == '__main__':
+    main()
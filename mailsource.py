@@ -0,0 +1,288 @@
+from typing import *
+import os
+import os.path
+import re
+import sys
+import glob
+import mmap
+import datetime
+import email.utils
+
+import rakuten_pay_mail_parser as r_pay
+import parse_cache
+import stats
+
+join_path = os.path.join
+
+# ============================
+# mailboxes other than Becky!
+#  mbox   : one file. split at "From " lines of the memory-mapped file
+#  maildir: cur/ and new/ of the Maildir (and the Maildir++ sub folders)
+#  eml    : a directory of *.eml files
+# the mails are fed to the same pipeline as the bmf files (see becky.py)
+# ============================
+
+BECKY   = 'becky'
+MBOX    = 'mbox'
+MAILDIR = 'maildir'
+EML     = 'eml'
+FORMATS = (BECKY, MBOX, MAILDIR, EML)
+
+MBOX_TASK_BYTES = 64 * 1024 * 1024
+"an mbox file is split into tasks of about this size at the \"From \" lines"
+FILES_PER_TASK  = 256
+PEEK_BYTES      = 16 * 1024
+"head of a mail file read first. the rest is read only when the header looks like a rakuten pay mail"
+
+MAIN_STATS = stats.counter('main')
+
+def w(msg:str):
+    print(msg, file=sys.stderr)
+
+def detect_format(path:str):
+    if os.path.isfile(path):
+        return MBOX
+    if os.path.isdir(join_path(path, 'cur')) and os.path.isdir(join_path(path, 'new')):
+        return MAILDIR
+    if glob.glob('**/Folder.idx', root_dir=path, recursive=True):
+        return BECKY
+    return EML
+
+class Period(NamedTuple):
+    since: Optional[datetime.datetime]
+    until: Optional[datetime.datetime]
+    "inclusive, same as becky.py"
+
+    def includes(self, d:Optional[datetime.datetime]):
+        "a mail whose date is unknown is included"
+        if d is None:
+            return True
+        if self.since is not None and d < self.since:
+            return False
+        if self.until is not None and d > self.until + datetime.timedelta(days=1):
+            return False
+        return True
+
+# =====================================
+# mbox
+# =====================================
+MBOX_FROM = b'\nFrom '
+MONTHS = { m: i for i, m in enumerate([b'Jan', b'Feb', b'Mar', b'Apr', b'May', b'Jun', b'Jul', b'Aug', b'Sep', b'Oct', b'Nov', b'Dec'], 1) }
+# From sender Sat Jan  3 01:05:34 1996 / From 123@xxx Fri Jan 01 00:00:00 +0000 2021
+RE_MBOX_FROM_DATE = re.compile(rb'([A-Z][a-z]{2}) +(\d{1,2}) (\d\d):(\d\d):(\d\d) (?:[+-]\d{4} )?(\d{4})\s*$')
+
+def _mbox_from_date(line:bytes):
+    "date of the \"From \" line as it is written (local time of the writer). None: unknown"
+    m = RE_MBOX_FROM_DATE.search(line)
+    if m is None or m.group(1) not in MONTHS:
+        return None
+    mon, day, hh, mm, ss, year = m.groups()
+    try:
+        return datetime.datetime(int(year), MONTHS[mon], int(day), int(hh), int(mm), int(ss))
+    except ValueError:
+        return None
+
+class MboxTask(NamedTuple):
+    path: str
+    start: int
+    end: int
+    "byte range of the mails. starts at a \"From \" line"
+
+    @property
+    def size(self):
+        return self.end - self.start
+
+    def read(self, period:Period, lookup:Optional[parse_cache.ParseCache]=None):
+        """
+        yields (None, mail) as zero-copy memoryviews over the memory-mapped file,
+        without the "From " line. the views are valid only until the generator is closed.
+        """
+        with open(self.path, 'rb') as h:
+            if os.fstat(h.fileno()).st_size == 0:
+                return
+            file = mmap.mmap(h.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            file.madvise(mmap.MADV_SEQUENTIAL)
+        except (AttributeError, OSError):
+            # not available on windows
+            pass
+
+        view = memoryview(file)
+        try:
+            start = self.start
+            while start < self.end:
+                with stats.stage('split'):
+                    next_from = file.find(MBOX_FROM, start, self.end)
+                    end = self.end if next_from < 0 else next_from + 1
+                    line_end = file.find(b'\n', start, end)
+                    body = end if line_end < 0 else line_end + 1
+                MAIN_STATS['bytes_read'] += end - start
+                if period.includes(_mbox_from_date(file[start:body])):
+                    yield None, view[body:end]
+                start = end
+        finally:
+            view.release()
+            try:
+                file.close()
+            except BufferError:
+                # a caller still holds a slice. the map is released by GC.
+                pass
+
+def _mbox_tasks(path:str, task_bytes:int):
+    size = os.path.getsize(path)
+    if size == 0:
+        return []
+    bounds = [0]
+    with open(path, 'rb') as h:
+        file = mmap.mmap(h.fileno(), 0, access=mmap.ACCESS_READ)
+    with file:
+        offset = task_bytes
+        while offset < size:
+            i = file.find(MBOX_FROM, max(offset, bounds[-1]))
+            if i < 0:
+                break
+            bounds.append(i + 1)
+            offset = i + 1 + task_bytes
+    bounds.append(size)
+    return [ MboxTask(path, start, end) for start, end in zip(bounds, bounds[1:]) ]
+
+# =====================================
+# Maildir / *.eml
+# =====================================
+RE_DATE_HEADER = re.compile(rb'^date:[ \t]*(.*(?:\r?\n[ \t].*)*)', re.I | re.M)
+RE_HEADER_END  = re.compile(rb'\r?\n\r?\n')
+
+def _maildir_date(path:str):
+    "delivery time in the file name (1700000000.M1P2.host:2,S)"
+    name = os.path.basename(path)
+    stamp = name.split('.', 1)[0]
+    return datetime.datetime.fromtimestamp(int(stamp)) if stamp.isdigit() else None
+
+def _header_date(head:bytes):
+    "Date of the header in local time. None: unknown"
+    m = RE_DATE_HEADER.search(head)
+    if m is None:
+        return None
+    try:
+        d = email.utils.parsedate_to_datetime(m.group(1).decode('ascii', 'replace'))
+    except (TypeError, ValueError):
+        return None
+    return d.astimezone().replace(tzinfo=None) if d.tzinfo else d
+
+class FilesTask(NamedTuple):
+    path: str
+    "the folder. for the messages and the dumps"
+    files: List[Tuple[str, int]]
+    "(path, size) ordered by inode, so that they are read mostly sequentially"
+    maildir: bool
+
+    @property
+    def size(self):
+        return sum(size for _, size in self.files)
+
+    def read(self, period:Period, lookup:Optional[parse_cache.ParseCache]=None):
+        """
+        yields (cache key, mail). the mail is None when it is in the parse cache.
+        a file is read with one read() call. a big one is read in two:
+        the head, and the rest only when the head can't tell it is not a rakuten pay mail.
+        .eml files are filtered by the Date header, so their head is read before the cache is looked up.
+        """
+        dated = not self.maildir and (period.since is not None or period.until is not None)
+        for path, _ in self.files:
+            if self.maildir and not period.includes(_maildir_date(path)):
+                continue
+            try:
+                with open(path, 'rb', buffering=0) as h:
+                    head = None
+                    if dated:
+                        with stats.stage('read'):
+                            head = h.read(PEEK_BYTES)
+                        MAIN_STATS['bytes_read'] += len(head)
+                        if not period.includes(_header_date(RE_HEADER_END.split(head, 1)[0])):
+                            continue
+                    key = None
+                    if lookup is not None:
+                        key = parse_cache.file_key(path, os.fstat(h.fileno()))
+                        if key in lookup:
+                            yield key, None
+                            continue
+                    if head is None:
+                        with stats.stage('read'):
+                            head = h.read(PEEK_BYTES)
+                        MAIN_STATS['bytes_read'] += len(head)
+                    if len(head) == PEEK_BYTES:
+                        complete = RE_HEADER_END.search(head) is not None
+                        if complete and not r_pay.peek_rakuten_pay_mail(head):
+                            # no need to read the body. the pipeline peeks the header again
+                            yield key, head
+                            continue
+                        with stats.stage('read'):
+                            rest = h.read()
+                        MAIN_STATS['bytes_read'] += len(rest)
+                        head += rest
+                yield key, head
+            except FileNotFoundError:
+                # moved from new/ to cur/ by the mail client
+                w(f'mail file not found...: {path}')
+
+def _scan_files(dir_path:str, is_mail:Callable[[os.DirEntry], bool]):
+    "(path, size, inode) of the mail files under the directory"
+    ret: List[Tuple[str, int, int]] = []
+    try:
+        entries = list(os.scandir(dir_path))
+    except FileNotFoundError:
+        return ret
+    for entry in entries:
+        if entry.is_dir(follow_symlinks=False):
+            ret += _scan_files(entry.path, is_mail)
+        elif entry.is_file() and is_mail(entry):
+            ret.append((entry.path, entry.stat().st_size, entry.inode()))
+    return ret
+
+def _files_tasks(path:str, files:List[Tuple[str, int, int]], maildir:bool, files_per_task:int):
+    # the inode order is close to the order on the disk
+    files = sorted(files, key=lambda f: f[2])
+    return [
+        FilesTask(path, [ (p, size) for p, size, _ in files[i:i+files_per_task] ], maildir)
+        for i in range(0, len(files), files_per_task)
+    ]
+
+def _maildir_folders(path:str):
+    "the Maildir and the Maildir++ sub folders (.Folder/cur, .Folder/new)"
+    yield path
+    for entry in sorted(os.scandir(path), key=lambda e: e.name):
+        if entry.name.startswith('.') and entry.is_dir() and os.path.isdir(join_path(entry.path, 'cur')):
+            yield entry.path
+
+def _maildir_tasks(path:str, files_per_task:int):
+    def is_mail(entry:os.DirEntry):
+        return not entry.name.startswith('.')
+
+    tasks = []
+    for folder in _maildir_folders(path):
+        files = _scan_files(join_path(folder, 'cur'), is_mail) + _scan_files(join_path(folder, 'new'), is_mail)
+        w(f'found: {folder} / {len(files)} mails')
+        tasks += _files_tasks(folder, files, True, files_per_task)
+    return tasks
+
+def _eml_tasks(path:str, files_per_task:int):
+    def is_mail(entry:os.DirEntry):
+        return entry.name.lower().endswith('.eml')
+
+    files = _scan_files(path, is_mail)
+    w(f'found: {path} / {len(files)} mails')
+    return _files_tasks(path, files, False, files_per_task)
+
+# =====================================
+SourceTask = MboxTask | FilesTask
+
+def enumerate_tasks(path:str, format:str):
+    if format == MBOX:
+        tasks = _mbox_tasks(path, MBOX_TASK_BYTES)
+        w(f'found: {path} / {os.path.getsize(path)} bytes / {len(tasks)} tasks')
+        return tasks
+    if format == MAILDIR:
+        return _maildir_tasks(path, FILES_PER_TASK)
+    if format == EML:
+        return _eml_tasks(path, FILES_PER_TASK)
+    raise ValueError(f'not a mailsource format: {format}')
@@ -0,0 +1,47 @@
+from typing import *
+import gc
+import glob
+import argparse
+import tracemalloc
+
+import becky
+
+# ============================
+# memory per record
+# ============================
+
+def _measure(load:Callable[[], List[Any]]):
+    "returns (record count, retained bytes per record)"
+    gc.collect()
+    tracemalloc.start()
+    try:
+        before  = tracemalloc.get_traced_memory()[0]
+        records = load()
+        gc.collect()
+        after   = tracemalloc.get_traced_memory()[0]
+    finally:
+        tracemalloc.stop()
+    count = len(records)
+    return count, (after - before) / count if count else 0
+
+def report(mail_box_path:str):
+    def load_idx():
+        idx_list = glob.glob('**/Folder.idx', root_dir=mail_box_path, recursive=True)
+        return sum((becky._load_folder_idx(becky.join_path(mail_box_path, p)) for p in idx_list), [])
+
+    def load_mails():
+        return list(becky.get_rakuten_pay_mails(mail_box_path))
+
+    becky.argv = becky.CLIParameter(mail_box_path, None, None)
+    for name, load in [('FolderIdxEntity', load_idx), ('RakutenPayMail', load_mails)]:
+        count, per_record = _measure(load)
+        print(f'{name}: {count} records / {per_record:.0f} bytes per record')
+
+def _main():
+    p = argparse.ArgumentParser(description='reports the memory retained per Folder.idx entity and per parsed mail')
+    p.add_argument('mail_box_path', help='specify the directory to *.bmf files.', type=str)
+    opt = p.parse_args()
+    report(opt.mail_box_path)
+
+if __name__ == '__main__':
+    _main()
@@ -0,0 +1,65 @@
+from typing import *
+import os.path
+import sqlite3
+import pickle
+import hashlib
+
+import rakuten_pay_mail_parser as r_pay
+
+# ============================
+# on-disk cache of parse results
+# ============================
+
+def index_key(bmf_path:str, body_ptr:int, size:int, msgid:str | bytes):
+    "key of a mail located by Folder.idx. the mail needn't be read to look it up."
+    if isinstance(msgid, bytes):
+        msgid = msgid.decode('ascii', errors='replace')
+    return f'idx:{os.path.abspath(bmf_path)}:{body_ptr:x}:{size:x}:{msgid}'
+
+def file_key(path:str, st:os.stat_result):
+    "key of a mail file (Maildir, .eml). the file needn't be read to look it up."
+    return f'file:{os.path.abspath(path)}:{st.st_size:x}:{st.st_mtime_ns:x}'
+
+def raw_key(mail_raw:bytes | memoryview):
+    "key of a mail found by scanning the bmf file. the raw bytes contain Message-ID, so the hash is enough"
+    return f'raw:{hashlib.sha1(mail_raw).hexdigest()}'
+
+class ParseCache:
+    """
+    keeps the RakutenPayMail of each mail. None is stored for non rakuten pay mails.
+    all entries are dropped when r_pay.PARSER_VERSION changes.
+    """
+    def __init__(self, path:str):
+        self.conn = sqlite3.connect(path, timeout=60)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS mails (key TEXT PRIMARY KEY, result BLOB)')
+
+        version = str(r_pay.PARSER_VERSION)
+        row = self.conn.execute("SELECT value FROM meta WHERE key = 'parser_version'").fetchone()
+        if row is None or row[0] != version:
+            self.conn.execute('DELETE FROM mails')
+            self.conn.execute("INSERT OR REPLACE INTO meta VALUES ('parser_version', ?)", (version,))
+        self.conn.commit()
+
+    def __contains__(self, key:str):
+        return self.conn.execute('SELECT 1 FROM mails WHERE key = ?', (key,)).fetchone() is not None
+
+    def get(self, key:str) -> Tuple[bool, Optional[r_pay.RakutenPayMail]]:
+        "returns (hit, result)"
+        row = self.conn.execute('SELECT result FROM mails WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            return False, None
+        result = row[0]
+        return True, None if result is None else pickle.loads(result)
+
+    def put(self, key:str, pay_mail:Optional[r_pay.RakutenPayMail]):
+        result = None if pay_mail is None else pickle.dumps(pay_mail)
+        self.conn.execute('INSERT OR REPLACE INTO mails VALUES (?, ?)', (key, result))
+
+    def commit(self):
+        self.conn.commit()
+
+    def close(self):
+        self.conn.commit()
+        self.conn.close()
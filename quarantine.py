@@ -0,0 +1,178 @@
+from typing import *
+import re
+import sys
+import json
+import queue
+import hashlib
+import zipfile
+import threading
+import traceback
+import collections
+
+import rakuten_pay_mail_parser as r_pay
+
+# ============================
+# failed mails (becky.py --failures)
+# the failures are grouped by signature: the subject and where each template failed.
+# only the first samples of a signature are formatted and stored, in one zip file with index.json
+# ============================
+
+def w(msg:str):
+    print(msg, file=sys.stderr)
+
+def _last_frame(ex:BaseException):
+    tb = ex.__traceback__
+    if tb is None:
+        return ('', 0)
+    while tb.tb_next is not None:
+        tb = tb.tb_next
+    return (tb.tb_frame.f_code.co_name, tb.tb_lineno)
+
+RE_DIGITS = re.compile(r'\d+')
+def signature(ex:r_pay.UnexcpectedRakutenPayMailException):
+    """
+    (signature, title). no trace is formatted, only the last frames are looked at.
+    a changed template fails at the same place for all of its mails.
+    a mail parsed with has_error is told by its template and the values not found.
+    """
+    subject = RE_DIGITS.sub('#', ex.subject or '')
+    if ex.pay_mail is not None:
+        places = [ (type(ex.pay_mail).__name__, 'missing', ','.join(ex.pay_mail.missing_fields())) ]
+        title  = f'{subject} / {places[0][0]} missing {places[0][2]}'
+    else:
+        attempts = ex.stack_trace_list or [ex]
+        places   = [ (type(e).__name__, *_last_frame(e)) for e in attempts ]
+        title    = f'{subject} / ' + ' / '.join(f'{name} at {func}:{line}' for name, func, line in places)
+    key = repr((subject, places))
+    return hashlib.blake2b(key.encode('utf-8', 'surrogateescape'), digest_size=6).hexdigest(), title
+
+def format_failure(ex:r_pay.UnexcpectedRakutenPayMailException):
+    "the traces of the failed templates and of the exception itself"
+    stack_list = [ ''.join(traceback.format_exception(e)) for e in ex.stack_trace_list or [] ]
+    stack_list.append(''.join(traceback.format_exception(ex)))
+    rec = [
+        f"from: {ex.from_}",
+        f"subject: {ex.subject}",
+        f"msgid: {ex.msgid}",
+    ]
+    if ex.pay_mail is not None:
+        rec.append(f"missing: {type(ex.pay_mail).__name__}: {', '.join(ex.pay_mail.missing_fields())}")
+    rec += [
+        "",
+        f"{ex.mail_body}",
+        "--------",
+        '--------'.join(stack_list),
+    ]
+    return '\n'.join(rec)
+
+class FailureRecord(NamedTuple):
+    signature: str
+    source: str         # bmf file, mbox, ...
+    msgid: Optional[str]
+    mail_raw: bytes
+    info: str | BaseException
+    "the exception is formatted by the writer thread"
+
+class FailureBuffer:
+    """
+    failures of a worker process. sent to the parent and merge()d into FailureSink.
+    only the first samples of each signature are formatted here.
+    """
+    def __init__(self, samples:int):
+        self.samples = samples
+        self.counts: Counter[str] = collections.Counter()
+        self.titles: Dict[str, str] = {}
+        self.records: List[FailureRecord] = []
+        self.unparsed: List[Tuple[str, Optional[str]]] = []
+        "(source, Message-ID) of the mails without a result. --state retries them"
+
+    def _count(self, source:str, msgid:Optional[str], ex:r_pay.UnexcpectedRakutenPayMailException):
+        "the signature, or None when the samples of the signature are full"
+        if ex.pay_mail is None:
+            self.unparsed.append((source, msgid))
+        sig, title = signature(ex)
+        self.counts[sig] += 1
+        if sig not in self.titles:
+            self.titles[sig] = title
+        return sig if self.counts[sig] <= self.samples else None
+
+    def capture(self, source:str, msgid:Optional[str], mail_raw:bytes | memoryview, ex:r_pay.UnexcpectedRakutenPayMailException):
+        sig = self._count(source, msgid, ex)
+        if sig is not None:
+            self.records.append(FailureRecord(sig, source, msgid, bytes(mail_raw), format_failure(ex)))
+
+_END = None
+
+class FailureSink(FailureBuffer):
+    """
+    writes the samples into one zip file by a background thread.
+      <signature>/<n>.eml : the raw mail
+      <signature>/<n>.txt : the source, the Message-ID and the traces
+      index.json          : count, title and samples of each signature. written by close()
+    the file is created only when a mail fails.
+    """
+    def __init__(self, path:str, samples:int=3):
+        super().__init__(samples)
+        self.path   = path
+        self.stored: Counter[str] = collections.Counter()
+        self.index: Dict[str, List[Dict[str, Any]]] = collections.defaultdict(list)
+        self.queue: queue.Queue = queue.Queue(maxsize=256)
+        self.zip: Optional[zipfile.ZipFile] = None
+        self.thread = threading.Thread(target=self._writer, name='becky-failures', daemon=True)
+        self.thread.start()
+
+    def capture(self, source:str, msgid:Optional[str], mail_raw:bytes | memoryview, ex:r_pay.UnexcpectedRakutenPayMailException):
+        sig = self._count(source, msgid, ex)
+        if sig is not None:
+            self._store(FailureRecord(sig, source, msgid, bytes(mail_raw), ex))
+
+    def merge(self, buffer:FailureBuffer):
+        self.counts.update(buffer.counts)
+        self.unparsed += buffer.unparsed
+        for sig, title in buffer.titles.items():
+            self.titles.setdefault(sig, title)
+        for record in buffer.records:
+            self._store(record)
+
+    def _store(self, record:FailureRecord):
+        if self.stored[record.signature] >= self.samples:
+            return
+        if not self.stored[record.signature]:
+            w(f'new failure: {record.signature}: {self.titles[record.signature]}')
+        self.stored[record.signature] += 1
+        self.queue.put(record)
+
+    def _open(self):
+        if self.zip is None:
+            self.zip = zipfile.ZipFile(self.path, 'w', zipfile.ZIP_DEFLATED)
+        return self.zip
+
+    def _writer(self):
+        while True:
+            record = self.queue.get()
+            if record is _END:
+                return
+            try:
+                n    = len(self.index[record.signature])
+                name = f'{record.signature}/{n:03}'
+                info = record.info if isinstance(record.info, str) else format_failure(record.info)
+                z = self._open()
+                z.writestr(f'{name}.eml', record.mail_raw)
+                z.writestr(f'{name}.txt', f'{record.source}\n{record.msgid}\n\n{info}')
+                self.index[record.signature].append({ 'source': record.source, 'msgid': record.msgid, 'mail': f'{name}.eml', 'info': f'{name}.txt' })
+            except Exception as ex:
+                w(f'failed to store a failed mail...: {self.path}: {ex}')
+
+    def close(self):
+        "returns the number of failures"
+        self.queue.put(_END)
+        self.thread.join()
+        if self.counts:
+            index = [
+                { 'signature': sig, 'title': self.titles[sig], 'count': count, 'samples': self.index.get(sig, []) }
+                for sig, count in self.counts.most_common()
+            ]
+            self._open().writestr('index.json', json.dumps({ 'failures': sum(self.counts.values()), 'signatures': index }, ensure_ascii=False, indent=1))
+        if self.zip is not None:
+            self.zip.close()
+        return sum(self.counts.values())
@@ -4,9 +4,8 @@ import sys
 import io
 import csv
 import functools
-import traceback
-import quopri
-import base64
+import binascii
+import html.parser
 import datetime as dt
 import email
 import email.utils
@@ -16,6 +15,7 @@ from   email.message import Message
 import bs4
 import dateutil.parser
 import util
+import stats
 
 class Mail(NamedTuple):
     body: str
@@ -33,6 +33,9 @@ def nullcoal(v:Optional[V], d:Optional[D]):
 # ============================
 # rakuten mail spec
 # ============================
+PARSER_VERSION = 3
+"bump this when the parse result changes. it invalidates the parse cache."
+
 RE_IS_HTML     = re.compile('<html.*?>', re.I)
 RE_PRE_ELEMENT = re.compile('<pre.*?>', re.I)
 
@@ -48,7 +51,23 @@ def _normalize_point(s:str):
     return int(s.replace('ポイント', ''))
 
 RE_REMOVE_WEEK = re.compile(r'[（\()][月火水木金土日][）\)]')
+# 2020/10/10(土) 00:00, 2018-12-18 18:30:21
+RE_RAKUTEN_DATETIME = re.compile(r'\s*(\d{4})[/-](\d{1,2})[/-](\d{1,2})(?:[（\(][月火水木金土日][）\)])?(?:\s+(\d{1,2}):(\d{2})(?::(\d{2}))?)?\s*')
+
+DATETIME_STATS:Counter[str] = stats.counter('datetime')
+"fast: parsed by RE_RAKUTEN_DATETIME, fallback: parsed by dateutil"
+
+def get_datetime_stats():
+    return dict(DATETIME_STATS)
+
+@stats.timed('datetime')
 def _normalize_datetime(s: str):
+    m = RE_RAKUTEN_DATETIME.fullmatch(s)
+    if m:
+        DATETIME_STATS['fast'] += 1
+        return dt.datetime(*(int(v) for v in m.groups(0)))
+
+    DATETIME_STATS['fallback'] += 1
     s = RE_REMOVE_WEEK.sub('', s)
     return dateutil.parser.parse(s)
 
@@ -65,6 +84,20 @@ _CSV_VALUE_HEADER = [
 class RakutenPayMail:
     CSV_VALUE_HEADER = _CSV_VALUE_HEADER
 
+    # no __dict__ per record. subclasses must declare __slots__, too.
+    __slots__ = (
+        'datetime', 'receipt_no', 'store_name', 'store_tel',
+        'use_point', 'use_cash', 'total', 'message_id', 'has_error',
+    )
+
+    SIGNATURE:Optional[str] = None
+    "regex found in the head of the mail body of this template. None: no signature"
+
+    @staticmethod
+    def match_mail(mail:'Mail'):
+        "extra test with from/subject"
+        return True
+
     def __init__(self):
         self.datetime:Optional[dt.datetime] = None
         self.receipt_no:Optional[str] = None
@@ -77,6 +110,26 @@ class RakutenPayMail:
         self.message_id:Optional[str] = None
         self.has_error = False
 
+    VALUE_FIELDS = ('datetime', 'receipt_no', 'store_name', 'store_tel', 'use_point', 'use_cash', 'total')
+
+    def missing_fields(self):
+        "the values not found in the mail"
+        return [ name for name in self.VALUE_FIELDS if getattr(self, name) is None ]
+
+    def _intern(self):
+        "the same store appears in many records"
+        if isinstance(self.store_name, str):
+            self.store_name = sys.intern(self.store_name)
+        if isinstance(self.store_tel, str):
+            self.store_tel = sys.intern(self.store_tel)
+
+    def __setstate__(self, state):
+        # pickle state of a __slots__ class: (None, {slot: value})
+        _, slots = state
+        for key, value in slots.items():
+            setattr(self, key, value)
+        self._intern()
+
     def csv_rawvalues(self):
         vals = [
             str(self.datetime),
@@ -113,6 +166,7 @@ class RakutenPayMail:
         return ' / '.join(f'{key}: {val}' for key, val in vals)
 
 class RakutenPayPlainText(RakutenPayMail):
+    __slots__ = ()
     RE_DATETIME   = _mk_re("ご利用日時")
     RE_RECEIPT_NO = _mk_re("伝票番号")
     RE_STORE_NAME = _mk_re("ご利用店舗")
@@ -134,6 +188,24 @@ class RakutenPayPlainText(RakutenPayMail):
     RE_PAY_GOV_NAME = _mk_re("お支払先")
     RE_PAY_GOV_YEAR = _mk_re("課税年度")
 
+    # label -> key of _parse_values()
+    LABEL_KEYS = {
+        "ご利用日時":     RE_DATETIME,
+        "伝票番号":       RE_RECEIPT_NO,
+        "ご利用店舗":     RE_STORE_NAME,
+        "電話番号":       RE_STORE_TEL,
+        "決済総額":       RE_TOTAL,
+        "ポイント／キャッシュ利用": RE_PAY_CASH_L,
+        "ポイント":       RE_PAY_POINT,
+        "楽天キャッシュ": RE_PAY_CASH,
+        "Suicaポケット発行依頼ID（伝票番号）": RE_SUICA_RECEIPT_NO,
+        "金額":           RE_SUICA_AMOUNT,
+        "お支払先":       RE_PAY_GOV_NAME,
+        "課税年度":       RE_PAY_GOV_YEAR,
+    }
+    # all labels in one regex. the longer label wins. ex) ポイント／キャッシュ利用 > ポイント
+    RE_LABEL = _mk_re('(' + '|'.join(map(re.escape, sorted(LABEL_KEYS, key=len, reverse=True))) + ')')
+
     def __init__(self, mail_body:str):
         super().__init__()
 
@@ -187,29 +259,20 @@ class RakutenPayPlainText(RakutenPayMail):
             self.total      = NY(V(S.RE_TOTAL))
     
     def _parse_values(self, lines) -> dict[re.Pattern, Optional[str]]:
+        """
+        single pass over the lines. the first line of each label wins.
+        """
         S = RakutenPayPlainText
-        keys = [
-            S.RE_DATETIME,
-            S.RE_RECEIPT_NO,
-            S.RE_STORE_NAME,
-            S.RE_STORE_TEL,
-            S.RE_TOTAL,
-            S.RE_PAY_CASH_L,
-            S.RE_PAY_POINT,
-            S.RE_PAY_CASH,
-            S.RE_SUICA_RECEIPT_NO,
-            S.RE_SUICA_AMOUNT,            
-            S.RE_PAY_GOV_NAME,
-            S.RE_PAY_GOV_YEAR,            
-        ]
-        def _get_record(regex: re.Pattern) -> Optional[str]:
-            for line in lines:
-                m = regex.search(line)
-                if m:
-                    return m.group(1).strip()
-            return None
-
-        return { key : _get_record(key) for key in keys }
+        values:dict[re.Pattern, Optional[str]] = dict.fromkeys(S.LABEL_KEYS.values())
+        search = S.RE_LABEL.search
+        for line in lines:
+            m = search(line)
+            if m is None:
+                continue
+            key = S.LABEL_KEYS[m.group(1)]
+            if values[key] is None:
+                values[key] = m.group(2).strip()
+        return values
 
     def _get_value(self, dic: Dict[re.Pattern, Optional[str]], pattern: re.Pattern):
         value = dic[pattern]
@@ -223,11 +286,145 @@ class RakutenPayPlainText(RakutenPayMail):
         return any(search(line) for line in lines)
 
 #=== html mail ===
+# where the value is, seen from the text node of the label
+LABEL_ROW  = 2 # node.parent.parent.next_sibling.next_sibling (<tr>label</tr><tr>value</tr>)
+LABEL_CELL = 1 # node.parent.next_sibling.next_sibling        (<td>label</td><td>value</td>)
+
+class RakutenPayHTMLLabelParser(html.parser.HTMLParser):
+    """
+    collects the values of the labels in one streaming pass, without building a DOM.
+    the result is the same as RakutenPayHTMLMailUtil.get_text(), as long as
+    the value element follows the label element with a white space text between them
+    (next_sibling.next_sibling). anything else is a miss, and the caller falls back to bs4.
+    """
+    VOID_ELEMENTS = frozenset([
+        'area', 'base', 'br', 'col', 'embed', 'hr', 'img', 'input',
+        'link', 'meta', 'param', 'source', 'track', 'wbr',
+    ])
+
+    def __init__(self, labels:Dict[str, int]):
+        super().__init__(convert_charrefs=True)
+        self.pending  = { label: (re.compile(label), level) for label, level in labels.items() }
+        self.waiting:List[list] = [] # [label, depth, state, texts]
+        self.values:Dict[str, str] = {}
+        self.stack:List[str] = []
+        self.text:List[str]  = []
+        self.miss = False
+
+    @classmethod
+    def extract(cls, mail_body:str, labels:Dict[str, int]) -> Optional[Dict[str, str]]:
+        "returns None on a miss"
+        parser = cls(labels)
+        try:
+            parser.feed(mail_body)
+            parser.close()
+            parser._flush()
+        except StopIteration:
+            pass # all values are found. the rest of the mail is not parsed.
+        if parser.miss or parser.pending or parser.waiting:
+            return None
+        return parser.values
+
+    def _flush(self):
+        if not self.text:
+            return
+        text = ''.join(self.text)
+        self.text = []
+
+        for label, (regex, level) in list(self.pending.items()):
+            if regex.search(text):
+                del self.pending[label]
+                depth = len(self.stack) - level
+                if depth < 0 or self.stack[depth] not in ('tr', 'td'):
+                    self.miss = True
+                    continue
+                self.waiting.append([label, depth, 'close', []])
+
+        for waiting in self.waiting:
+            label, depth, state, texts = waiting
+            if state == 'sibling':
+                if text.isspace():
+                    waiting[2] = 'separated'
+                else:
+                    self.miss = True
+            elif state == 'capture':
+                texts.append(text)
+
+    def handle_data(self, data):
+        self.text.append(data)
+
+    def handle_comment(self, data):
+        self._flush()
+        # bs4 finds the label in a comment, too.
+        if any(regex.search(data) for regex, level in self.pending.values()):
+            self.miss = True
+        if any(state in ('sibling', 'separated') for label, depth, state, texts in self.waiting):
+            self.miss = True
+
+    def handle_starttag(self, tag, attrs):
+        self._flush()
+        for waiting in self.waiting:
+            label, depth, state, texts = waiting
+            if state == 'separated' and len(self.stack) == depth:
+                waiting[2] = 'capture'
+            elif state == 'sibling' and len(self.stack) == depth:
+                # no text between the elements. next_sibling.next_sibling is another element
+                self.miss = True
+        if tag in self.VOID_ELEMENTS:
+            self._close_elements()
+        else:
+            self.stack.append(tag)
+
+    def handle_startendtag(self, tag, attrs):
+        self._flush()
+        self.handle_starttag(tag, attrs)
+        if tag not in self.VOID_ELEMENTS:
+            self.handle_endtag(tag)
+
+    def handle_endtag(self, tag):
+        self._flush()
+        if tag not in self.stack:
+            return
+        while self.stack.pop() != tag:
+            pass
+        self._close_elements()
+
+    def _close_elements(self):
+        for waiting in list(self.waiting):
+            label, depth, state, texts = waiting
+            if len(self.stack) > depth:
+                continue
+            if state == 'close' and len(self.stack) == depth:
+                waiting[2] = 'sibling'
+            elif state == 'capture':
+                self.values[label] = ''.join(texts).strip()
+                self.waiting.remove(waiting)
+                if not self.pending and not self.waiting:
+                    raise StopIteration
+            else:
+                # the parent is closed before the value element
+                self.miss = True
+
 class RakutenPayHTMLMailUtil:
-    def get_next_sibling_text(self, bs:bs4.BeautifulSoup, prev_key:str):
-        node = bs.find(string=re.compile(prev_key))
-        text = (''.join(node.parent.parent.next_sibling.next_sibling.strings)).strip()
+    def get_text(self, bs:bs4.BeautifulSoup, key:str, level:int):
+        node = bs.find(string=re.compile(key))
+        for _ in range(level):
+            node = node.parent
+        text = (''.join(node.next_sibling.next_sibling.strings)).strip()
         return text
+
+    def get_next_sibling_text(self, bs:bs4.BeautifulSoup, prev_key:str):
+        return self.get_text(bs, prev_key, LABEL_ROW)
+
+    def get_values(self, mail_body:str, labels:Dict[str, int], features:str):
+        """
+        label -> value. uses bs4 only when the streaming parser misses.
+        """
+        values = RakutenPayHTMLLabelParser.extract(mail_body, labels)
+        if values is not None:
+            return values
+        bs = bs4.BeautifulSoup(mail_body, features=features)
+        return { label: self.get_text(bs, label, level) for label, level in labels.items() }
 HTMLUtil = RakutenPayHTMLMailUtil()
 
 class RakutenPayMailHtml2018(RakutenPayMail):
@@ -236,21 +433,30 @@ class RakutenPayMailHtml2018(RakutenPayMail):
     - html00.html
     - html01.html ?
     """
+    __slots__ = ()
 
     #"：" が無いとHTMLのコメントにマッチして死ぬ…
     KEYWORD = 'ご利用ポイント上限：'
+    SIGNATURE = re.escape(KEYWORD)
+
+    LABELS = {
+        'お申込日：':         LABEL_ROW,
+        'お申込番号：':       LABEL_ROW,
+        'ご利用サイト：':     LABEL_ROW,
+        'ご利用ポイント上限：': LABEL_ROW,
+    }
 
     def __init__(self, mail_body:str):
         super().__init__()
+        S  = RakutenPayMailHtml2018
         ND = _normalize_datetime
-        GN = HTMLUtil.get_next_sibling_text
+        V  = HTMLUtil.get_values(mail_body, S.LABELS, 'lxml')
 
-        bs = bs4.BeautifulSoup(mail_body, features='lxml')
-        self.datetime   = ND(GN(bs, 'お申込日：'))
-        self.receipt_no = GN(bs, 'お申込番号：').strip()
-        self.store_name = GN(bs, 'ご利用サイト：')
+        self.datetime   = ND(V['お申込日：'])
+        self.receipt_no = V['お申込番号：'].strip()
+        self.store_name = V['ご利用サイト：']
         self.store_tel  = ''
-        self.use_point  = GN(bs, 'ご利用ポイント上限：')
+        self.use_point  = V['ご利用ポイント上限：']
         self.use_cash   = None
         self.total      = None
 
@@ -259,7 +465,9 @@ class RakutenPayMailHtml2018(RakutenPayMail):
         return ''.join(node.parent.parent.next_sibling.next_sibling.strings)
 
 class RakutenPayMailLegacy(RakutenPayMail):
+    __slots__ = ('lines',)
     RE_BODY_EXTRACTOR = re.compile(r"<pre>(.+?)</pre>", re.S)
+    SIGNATURE = RE_PRE_ELEMENT.pattern
 
     def __init__(self, mail_body:str):
         super().__init__()
@@ -293,43 +501,58 @@ class RakutenPayMailCurrent(RakutenPayMail):
     - html_current.html
     - html_current02.html
     """
+    __slots__ = ()
+    LABELS = {
+        'ご注文日：':     LABEL_ROW,
+        'ご注文番号：':   LABEL_ROW,
+        'ご利用サイト：': LABEL_ROW,
+        'ポイント(/キャッシュ)?利用：': LABEL_CELL,
+        '(小計|ご注文金額)：':          LABEL_CELL,
+    }
+
     def __init__(self, mail_body: str):
         super().__init__()
+        S  = RakutenPayMailCurrent
         NY = _normalize_yen
         ND = _normalize_datetime
-        GN = HTMLUtil.get_next_sibling_text
-        bs = bs4.BeautifulSoup(mail_body, features='html.parser')
+        V  = HTMLUtil.get_values(mail_body, S.LABELS, 'html.parser')
 
-        self.datetime   = ND(GN(bs, 'ご注文日：'))
-        self.receipt_no = GN(bs, 'ご注文番号：')
-        self.store_name = GN(bs, 'ご利用サイト：')
+        self.datetime   = ND(V['ご注文日：'])
+        self.receipt_no = V['ご注文番号：']
+        self.store_name = V['ご利用サイト：']
         self.store_tel  = ''
-        self.use_cash   = -NY(self._getRightText(bs, 'ポイント(/キャッシュ)?利用：'))
-        self.total      = NY(self._getRightText(bs, '(小計|ご注文金額)：'))
-
-    def _getRightText(self, bs, key: str):
-        targetNode = bs.find(string=re.compile(key))
-        text = (''.join(targetNode.parent.next_sibling.next_sibling.strings)).strip()
-        return text
+        self.use_cash   = -NY(V['ポイント(/キャッシュ)?利用：'])
+        self.total      = NY(V['(小計|ご注文金額)：'])
 
 class RakutenPayMailOrderConfirm(RakutenPayMail):
     """
     for
     - order.html
     """
+    __slots__ = ()
+    @staticmethod
+    def match_mail(mail:'Mail'):
+        return 'order@checkout.rakuten.co.jp' in mail.from_ and '楽天ペイ お申込完了' in mail.subject
+
+    LABELS = {
+        'ご利用ポイント/キャッシュ上限：': LABEL_ROW,
+        'お申込日：':   LABEL_ROW,
+        'お申込番号：': LABEL_ROW,
+        'お申込名：':   LABEL_ROW,
+    }
+
     def __init__(self, mail_body: str):
         super().__init__()
-        NY = _normalize_yen
+        S  = RakutenPayMailOrderConfirm
         ND = _normalize_datetime
-        GN = HTMLUtil.get_next_sibling_text
-        bs = bs4.BeautifulSoup(mail_body, features='html.parser')
+        V  = HTMLUtil.get_values(mail_body, S.LABELS, 'html.parser')
 
-        point = GN(bs, 'ご利用ポイント/キャッシュ上限：')
+        point = V['ご利用ポイント/キャッシュ上限：']
         point = point.replace("ポイント", '')
 
-        self.datetime   = ND(GN(bs, 'お申込日：'))
-        self.receipt_no = GN(bs, 'お申込番号：')
-        self.store_name = GN(bs, 'お申込名：')
+        self.datetime   = ND(V['お申込日：'])
+        self.receipt_no = V['お申込番号：']
+        self.store_name = V['お申込名：']
         self.store_tel  = ''
         self.use_cash   = int(point)
         self.total      = self.use_cash 
@@ -342,25 +565,54 @@ class UnexcpectedRakutenPayMailException(Exception):
         self.subject:str   = None
         self.msgid:str     = None
         self.email:Message = None
+        self.pay_mail:RakutenPayMail = None
+        "parsed, but has_error. None: no template could parse the mail"
 
 # === parser ===
-def _parse_mailbody_html(mail:Mail):
-    # if 'お客様のお申込情報を受けた時点で送信される自動配信メール' in mail_body:
-    #    e(f'{filePath} / ignore...')
-    #    wrap = ''
-    subject = mail.subject
-    from_   = mail.from_
-    def is_order_confirm_mail():
-        return 'order@checkout.rakuten.co.jp' in from_ and '楽天ペイ お申込完了' in subject
-
-    if RakutenPayMailHtml2018.KEYWORD in mail.body:
-        return RakutenPayMailHtml2018(mail.body)
-    elif is_order_confirm_mail():
-        return RakutenPayMailOrderConfirm(mail.body)
-    elif RE_PRE_ELEMENT.search(mail.body):
-        return RakutenPayMailLegacy(mail.body)
-    else:
-        return RakutenPayMailCurrent(mail.body)
+# candidates in priority order. the first template whose signature is found (and match_mail() is true) wins.
+HTML_TEMPLATES:List[Type[RakutenPayMail]] = [
+    RakutenPayMailHtml2018,
+    RakutenPayMailOrderConfirm,
+    RakutenPayMailLegacy,
+    RakutenPayMailCurrent,
+]
+TEXT_TEMPLATES:List[Type[RakutenPayMail]] = [
+    RakutenPayPlainText,
+]
+
+SIGNATURE_SCAN_SIZE = 32 * 1024
+"""
+only the head of the mail body is scanned for the signatures.
+the whole body is scanned when the head has none of them (a long plain text mail).
+a template signature after the head of an html mail is not looked for.
+"""
+
+def _mk_signature_re():
+    signatures = [ ('html', RE_IS_HTML.pattern) ] + [
+        (t.__name__, t.SIGNATURE) for t in HTML_TEMPLATES + TEXT_TEMPLATES if t.SIGNATURE is not None
+    ]
+    return re.compile('|'.join(f'(?P<{name}>{signature})' for name, signature in signatures), re.I)
+RE_SIGNATURES = _mk_signature_re()
+
+TEMPLATE_STATS:Counter[str] = stats.counter('template')
+"matched:<template>, failed:<template>, wasted_attempts (parts tried before the one parsed), full_scans (signatures searched in the whole body)"
+
+def get_template_stats():
+    return dict(TEMPLATE_STATS)
+
+@stats.timed('classify')
+def select_template(mail:Mail) -> Type[RakutenPayMail]:
+    found = { m.lastgroup for m in RE_SIGNATURES.finditer(mail.body, 0, SIGNATURE_SCAN_SIZE) }
+    if not found and len(mail.body) > SIGNATURE_SCAN_SIZE:
+        TEMPLATE_STATS['full_scans'] += 1
+        found = { m.lastgroup for m in RE_SIGNATURES.finditer(mail.body) }
+    templates = HTML_TEMPLATES if 'html' in found else TEXT_TEMPLATES
+    for template in templates:
+        if template.SIGNATURE is not None and template.__name__ not in found:
+            continue
+        if template.match_mail(mail):
+            return template
+    return templates[-1]
 
 #=== internal ===
 def _dump_mail(mail_body:str, msgid:str, filename:str, i:int):
@@ -376,11 +628,11 @@ def _dump_mail(mail_body:str, msgid:str, filename:str, i:int):
         print(mail_body, file=h, end='')
 
 def _decode_header(msg:Message, key:str):
-    def decode(seg:Tuple):
+    def charset_of(seg:Tuple):
         body, encode = seg
         # print(f"{body}:{encode}:{mail_charset}:{mail_content_type}", file=sys.stderr)
         if isinstance(body, str):
-            return body        
+            return None
 
         if encode in (None, 'unknown-8bit'):
             encode = msg.get_content_charset() # use the mail charset
@@ -390,32 +642,47 @@ def _decode_header(msg:Message, key:str):
         aster = encode.find('*')
         if aster >= 0:
             encode = encode[:aster]
-
-        try:
-            return util.decode(body, encode)
-        except UnicodeDecodeError:
-            msgid = msg['message-id']
-            w(f'Header decode error...:{msgid}:{key}')
-            return util.decode(body, encode or 'cp932', True)
+        return encode
 
     header = msg[key]
     if header is None:
         return None
-    header = email.header.decode_header(header)
-    return ''.join(map(decode, header))
+    header   = email.header.decode_header(header)
+    charsets = list(map(charset_of, header))
+    # the encoded fragments are decoded in one batch
+    encoded  = [ (body, encode) for (body, _), encode in zip(header, charsets) if encode is not None ]
+    try:
+        decoded = util.decode_many(encoded)
+    except UnicodeDecodeError:
+        msgid = msg['message-id']
+        w(f'Header decode error...:{msgid}:{key}')
+        decoded = util.decode_many(encoded, True)
 
-TRANS_DECODE_MAP:dict[str, Callable[[Any], bytes]] = {
-    'base64':           base64.b64decode,
-    'quoted-printable': quopri.decodestring,
-    '7bit':             quopri.decodestring,
+    decoded_iter = iter(decoded)
+    return ''.join(body if encode is None else next(decoded_iter) for (body, _), encode in zip(header, charsets))
+
+TRANS_DECODE_MAP:dict[str, Callable[[bytes], bytes]] = {
+    'base64':           binascii.a2b_base64,
+    'quoted-printable': binascii.a2b_qp,
+    '7bit':             binascii.a2b_qp,
 }
+@stats.timed('decode')
 def _get_mail_body(msg:Message):
     charset        = msg.get_content_charset()
-    trans_encoding = _decode_header(msg, 'Content-Transfer-Encoding')
+    # the value is a token. no need to decode it as a header
+    trans_encoding = str(msg.get('Content-Transfer-Encoding', '7bit')).strip().lower()
     # print(f"{charset} / {trans_encoding}")
-    raw_body = msg.get_payload()
+    decode  = TRANS_DECODE_MAP.get(trans_encoding)
+    payload = msg.get_payload()
+    if decode is not None and payload.isascii():
+        body = decode(payload.encode('ascii'))
+    else:
+        # 8bit/binary, or 8bit data in a 7bit part: the raw bytes.
+        # (get_payload() returns them already decoded by the charset)
+        body = msg.get_payload(decode=True)
+        if trans_encoding == '7bit':
+            body = binascii.a2b_qp(body)
 
-    body = TRANS_DECODE_MAP[trans_encoding](raw_body)
     try:
         return util.decode(body, charset)
     except UnicodeDecodeError:
@@ -423,11 +690,18 @@ def _get_mail_body(msg:Message):
         w(f'mailbody decode error...:{msgid}:{charset}:{trans_encoding}')
         return util.decode(body, charset, True)
 
-def _content_type_is_text_html(part:Message):
-    return part.get_content_type() == 'text/html'
-
-def _content_type_is_text_plain(part:Message):
-    return part.get_content_type() == 'text/plain'
+# parts tried in this order
+PART_PREFERENCE = {
+    'text/html':  0,
+    'text/plain': 1,
+}
+def _ranked_parts(msg:Message):
+    "text parts in the order of PART_PREFERENCE, in one walk. nothing is decoded here"
+    parts = [ (PART_PREFERENCE[part.get_content_type()], i, part)
+              for i, part in enumerate(msg.walk())
+              if part.get_content_type() in PART_PREFERENCE ]
+    parts.sort(key=lambda p: p[:2])
+    return [ part for _, _, part in parts ]
 
 def _get_rakuten_pay_mail_first(msg:Message, from_:str, subject:str):
     """
@@ -436,17 +710,19 @@ def _get_rakuten_pay_mail_first(msg:Message, from_:str, subject:str):
     """
     stack_trace_list = []
     msgid = _decode_header(msg, 'Message-ID')
-    for content_type_filter_func in [_content_type_is_text_html, _content_type_is_text_plain]:
-        for part in filter(content_type_filter_func, msg.walk()):
-            mail_body = 'decode failed...'
-            try:
-                mail_body = _get_mail_body(part)
-                # print(mail_body)
-                return parse_mailbody(Mail(mail_body, from_, subject))
-            except Exception as ex:
-                w(f'unexcepted rakuten pay mail format(1): {msgid}, {ex}, {traceback.format_exc()}')
-                stack_trace_list.append(traceback.format_exc())
-                continue
+    # only the parts actually tried are decoded
+    for part in _ranked_parts(msg):
+        mail_body = 'decode failed...'
+        try:
+            mail_body = _get_mail_body(part)
+            # print(mail_body)
+            return parse_mailbody(Mail(mail_body, from_, subject))
+        except Exception as ex:
+            TEMPLATE_STATS['wasted_attempts'] += 1
+            w(f'unexcepted rakuten pay mail format(1): {msgid}, {ex!r}')
+            # kept with its traceback. formatted only when the mail is stored (see quarantine.py)
+            stack_trace_list.append(ex)
+            continue
 
     w(f'unexcepted rakuten pay mail format(2): {msgid}')
     ex = UnexcpectedRakutenPayMailException()
@@ -456,32 +732,60 @@ def _get_rakuten_pay_mail_first(msg:Message, from_:str, subject:str):
     raise ex
 
 #=== api ===
+RAKUTEN_PAY_MAIL_ADDRESSES = frozenset([
+    'order@checkout.rakuten.co.jp',
+    'no-reply@pay.rakuten.co.jp'
+])
+IGNORE_MAIL_SUBJECTS = frozenset([
+    "お支払元登録完了のお知らせ"
+])
+@functools.lru_cache(maxsize=1024)
+def sender_address(from_:str):
+    "the address of the From field. '' for none. a mailbox has only a few senders"
+    if not from_:
+        return ''
+    return email.utils.getaddresses([from_])[0][1]
+
+def is_rakuten_pay_sender(address:str):
+    return address in RAKUTEN_PAY_MAIL_ADDRESSES
+
 def is_rakuten_pay_mail(from_:str, subject:str):
-    from_   = from_   or ''
+    from_   = sender_address(from_)
     subject = subject or ''
 
-    if from_:
-        parsed = email.utils.getaddresses([from_])
-        from_ = parsed[0][1]
-
-    def is_rakuten_pay_mail_address():
-        return from_ in [
-            'order@checkout.rakuten.co.jp',
-            'no-reply@pay.rakuten.co.jp'
-        ]
-
-    def is_ignore_mail():
-        return subject in  [
-            "お支払元登録完了のお知らせ"
-        ]
-
-    if not is_rakuten_pay_mail_address():
+    if not is_rakuten_pay_sender(from_):
         return False
-    if is_ignore_mail():
+    if subject in IGNORE_MAIL_SUBJECTS:
         return False
 
     return True
 
+RE_HEADER_END   = re.compile(rb'\r?\n\r?\n')
+RE_PEEK_HEADER  = re.compile(rb'^(from|subject|content-type):[ \t]*(.*(?:\r?\n[ \t].*)*)', re.I | re.M)
+def peek_rakuten_pay_mail(mail_raw:bytes | memoryview):
+    """
+    check From/Subject using only the header block of the raw mail.
+    the body (and attachments) are neither copied nor parsed.
+    """
+    m = RE_HEADER_END.search(mail_raw)
+    header_raw = mail_raw if m is None else mail_raw[:m.start()]
+
+    header = Message()
+    for m in RE_PEEK_HEADER.finditer(header_raw):
+        key, value = m.groups()
+        key = key.decode('ascii')
+        if key not in header:
+            header[key] = bytes(value).rstrip(b'\r').decode('ascii', 'surrogateescape')
+
+    # the address itself is never MIME encoded
+    from_raw = (header['from'] or '').lower()
+    if not any(address in from_raw for address in RAKUTEN_PAY_MAIL_ADDRESSES):
+        return False
+
+    subject = _decode_header(header, 'subject')
+    from_   = _decode_header(header, 'from')
+    return is_rakuten_pay_mail(from_, subject)
+
 def parse_email(mail:Message):
     """
     Raises:
@@ -509,6 +813,29 @@ def parse_email(mail:Message):
         ex.msgid   = msgid
         raise
 
+def error_exception(mail:Message, pay_mail:RakutenPayMail):
+    "the exception of a mail parsed by parse_email() with has_error"
+    ex = UnexcpectedRakutenPayMailException()
+    ex.from_    = _decode_header(mail, 'from')
+    ex.subject  = _decode_header(mail, 'subject')
+    ex.msgid    = pay_mail.message_id
+    ex.email    = mail
+    ex.pay_mail = pay_mail
+    return ex
+
+def parse_bytes(mail_raw:bytes):
+    """
+    Raises:
+        UnexcpectedRakutenPayMailException
+    """
+    with stats.stage('peek'):
+        if not peek_rakuten_pay_mail(mail_raw):
+            return None
+    with stats.stage('mime'):
+        mail = email.message_from_bytes(mail_raw)
+    with stats.stage('parse'):
+        return parse_email(mail)
+
 def parse_str(mail:Mail):
     if not is_rakuten_pay_mail(mail.from_, mail.subject):
         return None
@@ -520,10 +847,16 @@ def parse_mailbody(mail:Mail) -> RakutenPayMail:
         throw various exceptions....
         Caller must catch exceptions.
     """
-    if RE_IS_HTML.search(mail.body):
-        return _parse_mailbody_html(mail)
-    else:
-        return RakutenPayPlainText(mail.body)
+    template = select_template(mail)
+    TEMPLATE_STATS[f'matched:{template.__name__}'] += 1
+    try:
+        with stats.stage('extract'):
+            pay_mail = template(mail.body)
+        pay_mail._intern()
+        return pay_mail
+    except Exception:
+        TEMPLATE_STATS[f'failed:{template.__name__}'] += 1
+        raise
 
 def _main():
     import email
@@ -0,0 +1,199 @@
+from typing import *
+import sys
+import time
+import json
+import functools
+import contextlib
+import collections
+
+# ============================
+# per-stage timers and counters (--stats)
+# ============================
+
+ENABLED = False
+"the stage timers run only when enabled. the counters are always counted"
+
+class StageTime:
+    __slots__ = ('wall', 'cpu', 'calls')
+
+    def __init__(self):
+        self.wall  = 0.0
+        self.cpu   = 0.0
+        self.calls = 0
+
+STAGES: Dict[str, StageTime] = {}
+COUNTERS: Dict[str, Counter[str]] = {}
+
+def counter(group:str) -> Counter[str]:
+    "the counter of the group. it is merged from the worker processes"
+    return COUNTERS.setdefault(group, collections.Counter())
+
+class _Stage:
+    __slots__ = ('time', 'wall', 'cpu')
+
+    def __init__(self, stage_time:StageTime):
+        self.time = stage_time
+
+    def __enter__(self):
+        self.wall = time.perf_counter()
+        self.cpu  = time.process_time()
+
+    def __exit__(self, *exc):
+        t = self.time
+        t.wall  += time.perf_counter() - self.wall
+        t.cpu   += time.process_time() - self.cpu
+        t.calls += 1
+        return False
+
+_NULL_STAGE = contextlib.nullcontext()
+
+def stage(name:str):
+    """
+    with stats.stage('mime'):
+        ...
+    the stages may nest. the time of the inner stage is included in the outer one.
+    """
+    if not ENABLED:
+        return _NULL_STAGE
+    stage_time = STAGES.get(name)
+    if stage_time is None:
+        stage_time = STAGES[name] = StageTime()
+    return _Stage(stage_time)
+
+def timed(name:str):
+    "decorator version of stage()"
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not ENABLED:
+                return func(*args, **kwargs)
+            with stage(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+# === worker processes ===
+def snapshot():
+    "picklable copy of the stats. sent from a worker process to the parent"
+    return (
+        { name: (t.wall, t.cpu, t.calls) for name, t in STAGES.items() },
+        { group: dict(c) for group, c in COUNTERS.items() },
+    )
+
+def reset():
+    STAGES.clear()
+    for c in COUNTERS.values():
+        c.clear()
+
+def merge(snap:Tuple[Dict[str, Tuple[float, float, int]], Dict[str, Dict[str, int]]]):
+    stages, counters = snap
+    for name, (wall, cpu, calls) in stages.items():
+        t = STAGES.setdefault(name, StageTime())
+        t.wall  += wall
+        t.cpu   += cpu
+        t.calls += calls
+    for group, values in counters.items():
+        counter(group).update(values)
+
+# === report ===
+def report(elapsed:float, **extra):
+    """
+    wall/cpu of the stages are summed over the worker processes,
+    so they can be larger than the elapsed time of the run.
+    """
+    main = COUNTERS.get('main', {})
+    ret = {
+        'elapsed_sec': elapsed,
+        'mails_per_sec': main.get('mails', 0) / elapsed if elapsed else 0.0,
+        'mib_per_sec': main.get('bytes_read', 0) / 1024 / 1024 / elapsed if elapsed else 0.0,
+        'stages': {
+            name: {
+                'wall_sec': t.wall,
+                'cpu_sec':  t.cpu,
+                'calls':    t.calls,
+                'avg_usec': t.wall / t.calls * 1e6 if t.calls else 0.0,
+            }
+            for name, t in sorted(STAGES.items(), key=lambda kv: -kv[1].wall)
+        },
+        'counters': { group: dict(sorted(c.items())) for group, c in COUNTERS.items() },
+    }
+    ret.update(extra)
+    return ret
+
+def write_report(path:str, rep:Dict[str, Any]):
+    with open(path, 'w', encoding='utf-8') as h:
+        json.dump(rep, h, ensure_ascii=False, indent=2)
+        print(file=h)
+
+@contextlib.contextmanager
+def profiling(profile_path:Optional[str], trace_memory:bool, rep:Dict[str, Any]):
+    """
+    profile_path: write cProfile stats (pstats format) to the file
+    trace_memory: add the peak traced memory and the top allocations to rep['tracemalloc']
+    only the main process is profiled.
+    """
+    profiler = None
+    if profile_path is not None:
+        import cProfile
+        profiler = cProfile.Profile()
+    if trace_memory:
+        import tracemalloc
+        tracemalloc.start()
+    try:
+        if profiler is not None:
+            profiler.enable()
+        yield
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(profile_path)
+        if trace_memory:
+            current, peak = tracemalloc.get_traced_memory()
+            top = tracemalloc.take_snapshot().statistics('lineno')[:10]
+            tracemalloc.stop()
+            rep['tracemalloc'] = {
+                'current_bytes': current,
+                'peak_bytes': peak,
+                'top': [ { 'where': str(s.traceback), 'bytes': s.size, 'count': s.count } for s in top ],
+            }
+
+# === progress ===
+class Progress:
+    """
+    progress on stderr with throughput and ETA.
+    printed at most once per interval seconds, and once more by finish().
+    """
+    def __init__(self, total_bytes:int, total_tasks:int, interval:float=1.0, out:TextIO=None):
+        self.total_bytes = total_bytes
+        self.total_tasks = total_tasks
+        self.interval    = interval
+        self.out         = out
+        self.done_bytes  = 0
+        self.done_tasks  = 0
+        self.start       = time.perf_counter()
+        self.last        = self.start
+        self.printed_tasks = -1
+
+    def update(self, task_bytes:int):
+        self.done_bytes += task_bytes
+        self.done_tasks += 1
+        now = time.perf_counter()
+        if now - self.last >= self.interval:
+            self.last = now
+            self._print(now)
+
+    def finish(self):
+        if self.done_tasks != self.printed_tasks:
+            self._print(time.perf_counter())
+
+    def _print(self, now:float):
+        self.printed_tasks = self.done_tasks
+        elapsed = now - self.start
+        rate    = self.done_bytes / elapsed if elapsed else 0.0
+        remain  = (self.total_bytes - self.done_bytes) / rate if rate else 0.0
+        pct     = self.done_bytes * 100 / self.total_bytes if self.total_bytes else 100.0
+        mails   = counter('main')['mails']
+        print(f'{self.done_tasks}/{self.total_tasks} tasks ({pct:.1f}%)'
+              f' / {rate / 1024 / 1024:.1f} MiB/s / {mails / elapsed if elapsed else 0.0:,.0f} mails/s'
+              f' / ETA {int(remain) // 60}:{int(remain) % 60:02}',
+              file=self.out or sys.stderr, flush=True)
@@ -0,0 +1,85 @@
+from typing import *
+import csv
+import datetime
+
+import rakuten_pay_mail_parser as r_pay
+import columnar
+
+# ============================
+# running aggregates of RakutenPayMail (becky.py --summary)
+# ============================
+
+def _date_key(fmt:str):
+    def key(mail:r_pay.RakutenPayMail):
+        d = mail.datetime
+        return d.strftime(fmt) if isinstance(d, datetime.datetime) else ''
+    return key
+
+GROUP_KEYS: Dict[str, Callable[[r_pay.RakutenPayMail], str]] = {
+    'day':      _date_key('%Y-%m-%d'),
+    'month':    _date_key('%Y-%m'),
+    'year':     _date_key('%Y'),
+    'store':    lambda mail: mail.store_name or '',
+    'template': lambda mail: type(mail).__name__,
+}
+
+VALUE_HEADER = ['Count', 'Total', 'UsePoint', 'UseCash', 'Charged', 'Errors']
+
+def _amount(v:Any):
+    i = columnar._int(v)
+    return 0 if i == columnar.INT_NULL else i
+
+class Summary:
+    """
+    count, total, use_point, use_cash and errors per group.
+    only the groups are kept, not the mails. the summaries of the worker processes are merge()d.
+    """
+    def __init__(self, group_by:Sequence[str]):
+        unknown = [ name for name in group_by if name not in GROUP_KEYS ]
+        if unknown or not group_by:
+            raise ValueError(f'unknown group: {",".join(unknown)}. choose from {",".join(GROUP_KEYS)}')
+        self.group_by = tuple(group_by)
+        self.groups: Dict[Tuple[str, ...], List[int]] = {}
+        "key -> [count, total, use_point, use_cash, errors]"
+
+    def add(self, mail:r_pay.RakutenPayMail):
+        key = tuple(GROUP_KEYS[name](mail) for name in self.group_by)
+        values = self.groups.get(key)
+        if values is None:
+            values = self.groups[key] = [0, 0, 0, 0, 0]
+        values[0] += 1
+        values[1] += _amount(mail.total)
+        values[2] += _amount(mail.use_point)
+        values[3] += _amount(mail.use_cash)
+        values[4] += bool(mail.has_error)
+
+    def update(self, mails:Iterable[r_pay.RakutenPayMail]):
+        for mail in mails:
+            self.add(mail)
+        return self
+
+    def merge(self, other:'Summary'):
+        if other.group_by != self.group_by:
+            raise ValueError(f'group mismatch: {self.group_by} / {other.group_by}')
+        for key, values in other.groups.items():
+            mine = self.groups.get(key)
+            if mine is None:
+                self.groups[key] = list(values)
+            else:
+                for i, v in enumerate(values):
+                    mine[i] += v
+        return self
+
+    def header(self):
+        return [ name.capitalize() for name in self.group_by ] + VALUE_HEADER
+
+    def rows(self):
+        "sorted by the key"
+        for key in sorted(self.groups):
+            count, total, point, cash, errors = self.groups[key]
+            yield [*key, count, total, point, cash, total - point - cash, errors]
+
+    def write_csv(self, out:TextIO):
+        writer = csv.writer(out, lineterminator='\n', quoting=csv.QUOTE_NONNUMERIC)
+        writer.writerow(self.header())
+        writer.writerows(self.rows())
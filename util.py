@@ -1,44 +1,166 @@
 from typing import *
+import re
 import sys
 import codecs
+import functools
 
 # ============================
 # decode byte string
 # ============================
 
-def _decode_iso2022jp_nkf(b:bytes):
+def _decode_iso2022jp_nkf(b:bytes, errors:str='strict'):
     # require nkf module
     # https://github.com/fumiyas/python-nkf
     import nkf
     return nkf.nkf('-Jw', b).decode('utf-8')
 
-def _decode_iso2022jp_win(b:bytes):
-    dec, len = codecs.code_page_decode(50220, b)
+def _decode_iso2022jp_win(b:bytes, errors:str='strict'):
+    dec, len = codecs.code_page_decode(50220, b, errors, True)
     return dec
 
-decode_iso2022jp = _decode_iso2022jp_nkf
+# === CP50220 ===
+# ISO-2022-JP as decoded by windows (code page 50220).
+#  - JIS X 0208 is mapped like cp932 (ex: WAVE DASH -> FULLWIDTH TILDE)
+#  - NEC special characters (row 13) and NEC selected IBM extensions (row 89-92)
+#  - half-width katakana by ESC ( I, SO/SI, and raw 8bit bytes
+RE_ISO2022JP_ESCAPE = re.compile(rb'(\x1b\$[@B]|\x1b\([BJI]|\x0e|\x0f)')
+ISO2022JP_KANJI_ESCAPE = b'\x1b$B'
+
+# JIS X 0208 characters which python's iso2022_jp decodes differently from cp932
+JIS_TO_CP932_MAP = {
+    '〜': '～', # WAVE DASH -> FULLWIDTH TILDE
+    '‖': '∥', # DOUBLE VERTICAL LINE -> PARALLEL TO
+    '−': '－', # MINUS SIGN -> FULLWIDTH HYPHEN-MINUS
+    '¢': '￠', # CENT SIGN -> FULLWIDTH CENT SIGN
+    '£': '￡', # POUND SIGN -> FULLWIDTH POUND SIGN
+    '¬': '￢', # NOT SIGN -> FULLWIDTH NOT SIGN
+}
+JIS_TO_CP932_TRANSLATE = str.maketrans(JIS_TO_CP932_MAP)
+
+def _jis_to_cp932_chars(s:str):
+    # str.translate is slow on a long string. 'in' is fast, and the characters are rare
+    if any(c in s for c in JIS_TO_CP932_MAP):
+        return s.translate(JIS_TO_CP932_TRANSLATE)
+    return s
+
+# ESC ( I / SO: 0x21-0x5F are half-width katakana at 0xA1-0xDF of cp932
+KANA_TRANSLATE = bytes(c | 0x80 if 0x21 <= c <= 0x5f else c for c in range(256))
+
+def _jis_to_sjis(b:bytes):
+    "JIS X 0208 byte pairs -> shift_jis. bytes out of 0x21-0x7E are kept as they are."
+    out = bytearray()
+    i, n = 0, len(b)
+    while i < n:
+        c1 = b[i]
+        if not (0x21 <= c1 <= 0x7e) or i + 1 >= n:
+            out.append(c1)
+            i += 1
+            continue
+        c2 = b[i+1]
+        if c1 & 1:
+            s1 = (c1 + 1) // 2 + 0x70
+            s2 = c2 + 0x1f + (1 if c2 >= 0x60 else 0)
+        else:
+            s1 = c1 // 2 + 0x70
+            s2 = c2 + 0x7e
+        if s1 >= 0xa0:
+            s1 += 0x40
+        out += bytes((s1, s2))
+        i += 2
+    return bytes(out)
+
+def _decode_jis_kanji(seg:bytes, errors:str):
+    try:
+        # fast path. JIS X 0208 only
+        return _jis_to_cp932_chars((ISO2022JP_KANJI_ESCAPE + seg).decode('iso2022_jp'))
+    except UnicodeDecodeError:
+        # NEC/IBM extensions, or control characters in the kanji mode
+        return _jis_to_sjis(seg).decode('cp932', errors)
+
+def _decode_iso2022jp_cp50220(b:bytes, errors:str='strict'):
+    if b'\x1b' not in b and b'\x0e' not in b:
+        # no escape sequence. ascii (or raw 8bit half-width katakana)
+        return b.decode('cp932', errors)
+    if b'\x1b(J' not in b and b'\x0e' not in b:
+        try:
+            # fast path. ascii and JIS X 0208 only (python maps ESC ( J to yen sign/overline, and passes SO/SI through)
+            return _jis_to_cp932_chars(b.decode('iso2022_jp'))
+        except UnicodeDecodeError:
+            pass
+
+    ret: List[str] = []
+    mode = shift_mode = b'\x1b(B'
+    segments = RE_ISO2022JP_ESCAPE.split(b)
+    for i, seg in enumerate(segments):
+        if i % 2:
+            # escape sequence
+            if seg == b'\x0e':
+                shift_mode, mode = mode, seg
+            elif seg == b'\x0f':
+                mode = shift_mode
+            else:
+                mode = seg
+            continue
+        if not seg:
+            continue
+        if mode[1:2] == b'$':
+            ret.append(_decode_jis_kanji(seg, errors))
+        elif mode in (b'\x1b(I', b'\x0e'):
+            ret.append(seg.translate(KANA_TRANSLATE).decode('cp932', errors))
+        else:
+            ret.append(seg.decode('cp932', errors))
+    return ''.join(ret)
+
+decode_iso2022jp = _decode_iso2022jp_cp50220
 if sys.platform == 'win32':
     decode_iso2022jp = _decode_iso2022jp_win
 
+BATCH_SEPARATOR = b'\x00'
+def decode_iso2022jp_many(fragments:Sequence[bytes], errors:str='strict') -> List[str]:
+    """
+    decode many ISO-2022-JP fragments (ex: encoded-words of headers) at once.
+    each fragment starts in the ascii mode, the same as decoding them one by one.
+    """
+    if len(fragments) < 2 or any(BATCH_SEPARATOR in f for f in fragments):
+        return [ decode_iso2022jp(f, errors) for f in fragments ]
+    # ESC ( B resets the mode for the next fragment
+    joined = (b'\x1b(B' + BATCH_SEPARATOR).join(fragments)
+    return decode_iso2022jp(joined, errors).split(BATCH_SEPARATOR.decode('ascii'))
+
 ENCODING_ALIAS_MAP = {
     'windows-874': 'cp874',
 }
-DECODER_MEMO = {}
-def decode(b:bytes, encoding:str, ignore_error=False):
+
+@functools.lru_cache(maxsize=None)
+def _codec_name(encoding:str):
     encoding = ENCODING_ALIAS_MAP.get(encoding, encoding)
-    name = DECODER_MEMO.get(encoding)
-    if name is None:
-        c = codecs.lookup(encoding)
-        name = c.name
-        DECODER_MEMO[encoding] = name
+    return codecs.lookup(encoding).name
 
+def decode(b:bytes, encoding:str, ignore_error=False):
+    errors = 'ignore' if ignore_error else 'strict'
+    name = _codec_name(encoding)
     if name.startswith('iso2022_jp'):
         # iso2022_jp, iso2022_jp_1, iso2022_jp_2, iso2022_jp_2004, iso2022_jp_3, iso2022_jp_ext
-        # python で cp50220, cp50221 がサポートされてればなぁ…
-        return decode_iso2022jp(b)
+        # python は cp50220, cp50221 をサポートしていないので自前でデコードする
+        return decode_iso2022jp(b, errors)
 
     if name.startswith('shift_jis'):
         # shift_jis_2004, shift_jisx0213
-        encoding = 'cp932'
-    return b.decode(encoding, errors='ignore' if ignore_error else 'strict')
+        name = 'cp932'
+    return b.decode(name, errors)
 
+def decode_many(items:Iterable[Tuple[bytes, str]], ignore_error=False) -> List[str]:
+    "decode (bytes, encoding) pairs. the ISO-2022-JP ones are decoded in one batch"
+    items = list(items)
+    ret: List[Optional[str]] = [None] * len(items)
+    jis_index: List[int] = []
+    for i, (b, encoding) in enumerate(items):
+        if _codec_name(encoding).startswith('iso2022_jp'):
+            jis_index.append(i)
+        else:
+            ret[i] = decode(b, encoding, ignore_error)
+    if jis_index:
+        decoded = decode_iso2022jp_many([ items[i][0] for i in jis_index ], 'ignore' if ignore_error else 'strict')
+        for i, s in zip(jis_index, decoded):
+            ret[i] = s
+    return cast(List[str], ret)